@@ -6,6 +6,19 @@
 import sys
 import os
 import collections
+import pickle
+import math
+from array import array
+
+# numpy is only needed by the batch engine (SimPeriods and RunBatch), so it
+# is imported on first use; the plain run() doesn't pay for importing it.
+np = None
+def ImportNumpy():
+	global np
+	if np is None:
+		import numpy
+		np = numpy
+	return np
 
 class Options():
 	pass
@@ -14,51 +27,126 @@ opts.quiet = False
 opts.verbose = False
 opts.years = 30
 opts.rate = 0.04
+opts.batch = False
 
 class InsufficientFunds(Exception):
 	pass
 
+YearRecord = collections.namedtuple('YearRecord', 'year,withdrawal,dividend,cash,stock,shares,balance,actions')
+
 MarketDataValue = collections.namedtuple('MarketDataValue', 'price,dividend,earnings,cpi,gs10,real_price,real_dividend,real_earnings'.split(','))
 
 class MarketData(dict):
+	"""
+	Monthly (and year end) market data, keyed by (year,month) and year.
+
+	The parsed rows are cached in __marketcache__ next to the CSV file, keyed
+	on the file's path, size and modification time, so later runs can skip
+	parsing the text.
+	"""
 	def __init__(self, path="ie_data.csv"):
 		super().__init__()
-		minYear = None
-		maxYear = None
 		filename = os.path.expanduser(path)
-		with open(filename, 'rU') as f:
+		rows = self.ReadCache(filename)
+		if rows is None:
+			rows = self.ReadCSV(filename)
+			self.WriteCache(filename, rows)
+		for year, month, vals in rows:
+			self[(year,month)] = MarketDataValue(*vals)
+			if month == 12:
+				self[year] = MarketDataValue(*vals)
+		self.minYear = min(year for year, month, vals in rows)
+		self.maxYear = max(year for year, month, vals in rows)
+		self.yearArrays = {}
+	
+	def YearArray(self, field):
+		"""An array of the year end values of @field, indexed by year-minYear (NaN if missing)"""
+		if field not in self.yearArrays:
+			ImportNumpy()
+			values = [getattr(self[year], field) if year in self else None for year in range(self.minYear, self.maxYear+1)]
+			self.yearArrays[field] = np.array([np.nan if value is None else value for value in values])
+		return self.yearArrays[field]
+
+	@staticmethod
+	def ReadCSV(filename):
+		rows = []
+		with open(filename, 'r') as f:
 			l = f.readline()
 			assert l == "Year,Month,Price,Dividend,Earnings,CPI,GS10,Real Price,Real Dividend,Real Earnings\n"
 			for l in f:
 				fields = l.rstrip("\n").split(',')
 				assert len(fields) == 10
 				year,month = map(int, fields[0:2])
-			
-				if minYear is None:
-					minYear = year
-				elif year < minYear:
-					minYear = year
-			
-				if maxYear is None:
-					maxYear = year
-				elif year > maxYear:
-					maxYear = year
-			
-				vals = [None if x == "" else float(x) for x in fields[2:]]
-				self[(year,month)] = MarketDataValue(*vals)
-				if month == 12:
-					self[year] = MarketDataValue(*vals)
-		self.minYear = minYear
-		self.maxYear = maxYear
-marketData = MarketData()
+				vals = tuple(None if x == "" else float(x) for x in fields[2:])
+				rows.append((year, month, vals))
+		return rows
+
+	@staticmethod
+	def CachePath(filename):
+		directory, name = os.path.split(os.path.abspath(filename))
+		return os.path.join(directory, "__marketcache__", "MarketData-" + name + ".pickle")
+
+	@staticmethod
+	def CacheKey(filename):
+		stat = os.stat(filename)
+		return (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+
+	@classmethod
+	def ReadCache(cls, filename):
+		try:
+			with open(cls.CachePath(filename), 'rb') as f:
+				key, rows = pickle.load(f)
+			if key == cls.CacheKey(filename):
+				return rows
+		except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+			pass
+		return None
+
+	@classmethod
+	def WriteCache(cls, filename, rows):
+		cachePath = cls.CachePath(filename)
+		try:
+			os.makedirs(os.path.dirname(cachePath), exist_ok=True)
+			with open(cachePath + ".tmp", 'wb') as f:
+				pickle.dump((cls.CacheKey(filename), rows), f, pickle.HIGHEST_PROTOCOL)
+			os.replace(cachePath + ".tmp", cachePath)
+		except OSError:
+			pass		# Not being able to write the cache is harmless
+
+_marketData = {}
+
+def GetMarketData(path="ie_data.csv"):
+	"""Load the market data in @path on first use, and share it afterwards"""
+	if path not in _marketData:
+		_marketData[path] = MarketData(path)
+	return _marketData[path]
+
+def __getattr__(name):
+	# Keep StockMarket.marketData working, without loading it at import time
+	if name == 'marketData':
+		return GetMarketData()
+	raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 class Simulation():
+	"""
+	Each period keeps a log of the portfolio at the start of every year, and
+	of what SimYear did about the withdrawal.  The log is kept as records
+	(numbers in a flat array, plus (format, args) messages) and only turned
+	into text by LogText, when it is printed.  With opts.quiet (and not
+	opts.verbose) no log is kept at all.
+	"""
 	initialBalance = 1000000.00
+	yearFields = len(YearRecord._fields) - 1	# Numbers per year in yearLog
 	
-	def __init__(self):
+	def __init__(self, marketData=None):
+		"""@marketData defaults to GetMarketData(), loaded on first use"""
+		if marketData is None:
+			marketData = GetMarketData()
+		self.marketData = marketData
 		self.years = opts.years
 		self.withdrawalRate = opts.rate
-		self.logStr = ""
+		self.yearLog = None		# array of yearFields numbers per year, or None if not logging
+		self.actionLog = None	# list of (year index, format, args), or None if not logging
 		
 	def __repr__(self):
 		s = self.__class__.__name__ + "(" + \
@@ -66,48 +154,82 @@ class Simulation():
 			"balance={:,.2f}, cash={:,.2f}, stock={:,.2f}, ".format(self.balance, self.cash, self.stock) + \
 			"shares={:,.2f}, price={:,.2f})\n".format(self.shares, self.price)
 		if opts.quiet is not True:
-			s += self.logStr
+			s += self.LogText()
 		return s
 	
-	def Log(self, s):
-		self.logStr = self.logStr + s
+	def Log(self, fmt, *args):
+		"""Log fmt.format(*args) for the current year; the formatting is done by LogText"""
+		if self.actionLog is not None:
+			self.actionLog.append((len(self.yearLog) // self.yearFields - 1, fmt, args))
+	
+	def LogYear(self, dividend):
+		"""Log the portfolio at the start of the current year (@dividend is NaN for the first withdrawal)"""
+		if self.yearLog is not None:
+			self.yearLog.extend((self.year, self.withdrawal, dividend, self.cash, self.stock, self.shares, self.balance))
+	
+	def YearRecords(self):
+		"""The log of the last period, as a list of YearRecord"""
+		records = []
+		if self.yearLog is None:
+			return records
+		for i in range(0, len(self.yearLog), self.yearFields):
+			year, *values = self.yearLog[i:i+self.yearFields]
+			records.append(YearRecord(int(year), *values, []))
+		for index, fmt, args in self.actionLog:
+			records[index].actions.append(fmt.format(*args))
+		return records
+	
+	def LogText(self):
+		"""The log of the last period, formatted as text"""
+		lines = []
+		for r in self.YearRecords():
+			if math.isnan(r.dividend):
+				lines.append("    {}: withdrawal={:,.2f} cash={:,.2f} stock={:,.2f} shares={:,.2f} balance={:,.2f}; ".format(r.year, r.withdrawal, r.cash, r.stock, r.shares, r.balance))
+			else:
+				lines.append("    {}: withdrawal={:,.2f} dividends={:,.2f} cash={:,.2f} stock={:,.2f} shares={:,.2f} balance={:,.2f}; ".format(r.year, r.withdrawal, r.dividend, r.cash, r.stock, r.shares, r.balance))
+			lines.extend(r.actions)
+		return "".join(lines)
 	
 	def SimPeriod(self, startYear):
-		self.logStr = ""
+		if opts.verbose or not opts.quiet:
+			self.yearLog = array('d')
+			self.actionLog = []
+		else:
+			self.yearLog = self.actionLog = None
 		self.startYear = self.year = startYear
 		self.balance = self.initialBalance
 		self.initialWithdrawal = self.withdrawal = self.initialBalance * self.withdrawalRate
 		self.cash = 0
-		self.price = marketData[self.year].price
+		self.price = self.marketData[self.year].price
 		self.stock = self.initialBalance
 		self.shares = self.stock / self.price
 		if opts.verbose: print("{0}({1}):".format(self.__class__.__name__, startYear))
 		self.SimInit()		# Give the algorithm a chance to initialize itself
-		self.Log("    {}: withdrawal={:,.2f} cash={:,.2f} stock={:,.2f} shares={:,.2f} balance={:,.2f}; ".format(self.year, self.withdrawal, self.cash, self.stock, self.shares, self.balance))
+		self.LogYear(math.nan)
 		self.SimYear()		# Do the initial withdrawal
 		for year in range(startYear, startYear+self.years):
 			# Do subsequent years
 			self.year = year
 
 			# Adjust withdrawal for inflation
-			self.withdrawal = self.withdrawal * marketData[year].cpi / marketData[year-1].cpi
+			self.withdrawal = self.withdrawal * self.marketData[year].cpi / self.marketData[year-1].cpi
 
 			# Take a guess at interest earned on cash
-			self.cash = self.cash * (1 + marketData[year].gs10 / 300.0)
+			self.cash = self.cash * (1 + self.marketData[year].gs10 / 300.0)
 			
 			# Take dividend as cash
-			dividend = marketData[year].dividend * self.shares
+			dividend = self.marketData[year].dividend * self.shares
 			self.cash += dividend
 			
 			# Update stock price, stock value, and total value
-			self.price = marketData[year].price
+			self.price = self.marketData[year].price
 			self.stock = self.shares * self.price
 			self.balance = self.cash + self.stock
-			self.Log("    {}: withdrawal={:,.2f} dividends={:,.2f} cash={:,.2f} stock={:,.2f} shares={:,.2f} balance={:,.2f}; ".format(year, self.withdrawal, dividend, self.cash, self.stock, self.shares, self.balance))
+			self.LogYear(dividend)
 			
 			# Let the specific algorithm decide how to satisfy the withdrawal
 			self.SimYear()
-		if opts.verbose: print(self.logStr)
+		if opts.verbose: print(self.LogText())
 
 	def SimInit(self):
 		pass
@@ -115,10 +237,89 @@ class Simulation():
 	def SimYear(self):
 		pass
 	
+	def SimYearBatch(self):
+		"""
+		The batch equivalent of SimYear: the portfolio attributes are arrays
+		with one element per start year.  Returns a mask of the start years
+		that couldn't make the withdrawal (where SimYear would raise
+		InsufficientFunds).
+		"""
+		return np.zeros(len(self.balance), dtype=bool)
+	
+	def SimPeriods(self, startYears):
+		"""
+		Simulate the periods starting in each of @startYears at once, with the
+		portfolio attributes as arrays (one element, or "lane", per start year),
+		and with SimYearBatch in place of SimYear.  Nothing is logged.
+		
+		Returns (failed, durations): whether each period ran out of money, and
+		for those that did, the number of years before it happened (as in run).
+		"""
+		ImportNumpy()
+		startYears = np.asarray(startYears)
+		md = self.marketData
+		price, dividends, cpi, gs10 = (md.YearArray(field) for field in ('price', 'dividend', 'cpi', 'gs10'))
+		lane = startYears - md.minYear        # Index of each lane's start year
+		
+		self.startYear = startYears
+		self.balance = np.full(len(lane), self.initialBalance)
+		self.initialWithdrawal = self.withdrawal = np.full(len(lane), self.initialBalance * self.withdrawalRate)
+		self.cash = np.zeros(len(lane))
+		self.price = price[lane]
+		self.stock = np.full(len(lane), self.initialBalance)
+		self.shares = self.stock / self.price
+		self.SimInit()
+		failed = self.SimYearBatch()
+		durations = np.zeros(len(lane), dtype=int)
+		for offset in range(self.years):
+			# Do subsequent years; lanes that failed carry on, but are ignored
+			year = lane + offset
+			self.withdrawal = self.withdrawal * cpi[year] / cpi[year-1]
+			self.cash = self.cash * (1 + gs10[year] / 300.0)
+			dividend = dividends[year] * self.shares
+			self.cash = self.cash + dividend
+			self.price = price[year]
+			self.stock = self.shares * self.price
+			self.balance = self.cash + self.stock
+			newlyFailed = self.SimYearBatch() & ~failed
+			durations[newlyFailed] = offset
+			failed |= newlyFailed
+		return failed, durations
+	
+	def RunBatch(self):
+		"""
+		Like run, using SimPeriods; returns (failures, average failure duration in years)
+		
+		>>> import contextlib, io
+		>>> def summary(method):
+		...     with contextlib.redirect_stdout(io.StringIO()) as out:
+		...         method()
+		...     return out.getvalue().splitlines()[-1:]
+		>>> quiet, opts.quiet = opts.quiet, True
+		>>> mismatches = []
+		>>> for strategy in (AllStock, NinetyTen, EightyTwenty, FiftyFifty, CashCushion):
+		...     for years in (20, 30, 40):
+		...         for rate in (0.04, 0.05, 0.06):
+		...             simulation = strategy()
+		...             simulation.years, simulation.withdrawalRate = years, rate
+		...             if summary(simulation.run) != summary(simulation.RunBatch):
+		...                 mismatches.append((strategy.__name__, years, rate))
+		>>> opts.quiet = quiet
+		>>> mismatches
+		[]
+		"""
+		failed, durations = self.SimPeriods(ImportNumpy().arange(self.marketData.minYear+1, self.marketData.maxYear-self.years+2))
+		failures = int(failed.sum())
+		failDuration = int(durations[failed].sum())
+		if failures != 0:
+			print("{0}: {1} failed periods (avg. {2} years)".format(self.__class__.__name__, failures, failDuration/failures))
+			return failures, failDuration/failures
+		return failures, 0
+	
 	def run(self):
 		failures = 0
 		failDuration = 0
-		for startYear in range(marketData.minYear+1, marketData.maxYear-self.years+2):
+		for startYear in range(self.marketData.minYear+1, self.marketData.maxYear-self.years+2):
 			try:
 				self.SimPeriod(startYear)
 			except InsufficientFunds as ex:
@@ -142,10 +343,19 @@ class AllStock(Simulation):
 			sellShares = (self.withdrawal - self.cash) / self.price
 			if sellShares > self.shares:
 				raise InsufficientFunds(self)
-			self.Log("using cash; selling stock ({:,.2f}; {:,.2f} shares)\n".format(self.withdrawal-self.cash, sellShares))
+			self.Log("using cash; selling stock ({:,.2f}; {:,.2f} shares)\n", self.withdrawal-self.cash, sellShares)
 			self.shares -= sellShares
 			self.cash = 0.0
 			self.balance = self.stock = self.shares * self.price
+	def SimYearBatch(self):
+		useCash = self.cash >= self.withdrawal
+		sellShares = (self.withdrawal - self.cash) / self.price
+		failed = ~useCash & (sellShares > self.shares)
+		self.shares = np.where(useCash, self.shares, self.shares - sellShares)
+		self.stock = np.where(useCash, self.stock, self.shares * self.price)
+		self.balance = np.where(useCash, self.balance - self.withdrawal, self.stock)
+		self.cash = np.where(useCash, self.cash - self.withdrawal, 0.0)
+		return failed
 
 class NinetyTen(Simulation):
 	"""Portfolio is 90% stock, 10% cash, rebalanced each year"""
@@ -163,9 +373,14 @@ class NinetyTen(Simulation):
 		self.Rebalance()
 		newShares = self.shares
 		if newShares < oldShares:
-			self.Log("selling stock ({:,.2f}; {:,.2f} shares)\n".format((oldShares-newShares) * self.price, oldShares-newShares))
+			self.Log("selling stock ({:,.2f}; {:,.2f} shares)\n", (oldShares-newShares) * self.price, oldShares-newShares)
 		else:
-			self.Log("buying stock ({:,.2f}; {:,.2f} shares)\n".format((newShares-oldShares) * self.price, newShares-oldShares))
+			self.Log("buying stock ({:,.2f}; {:,.2f} shares)\n", (newShares-oldShares) * self.price, newShares-oldShares)
+	def SimYearBatch(self):
+		failed = self.balance < self.withdrawal
+		self.balance = self.balance - self.withdrawal
+		self.Rebalance()
+		return failed
 
 class EightyTwenty(NinetyTen):
 	"""Portfolio is 80% stock, 20% cash, rebalanced each year"""
@@ -201,17 +416,19 @@ class CashCushion(Simulation):
 					raise InsufficientFunds(self)
 				self.shares -= sellShares
 				self.cash = 0.0
-				self.Log("using cash; selling stock ({:,.2f}; {:,.2f} shares)\n".format(sellShares * self.price, sellShares))
+				self.Log("using cash; selling stock ({:,.2f}; {:,.2f} shares)\n", sellShares * self.price, sellShares)
 		else:
 			# Sell stock.  Possibly replenish cash cushion.
 			msg = ""
+			msgArgs = []
 			withdrawal = self.withdrawal
 			useCash = 0.0
 			if self.cash > self.cashGoal:
 				useCash = min(self.withdrawal, self.cash - self.cashGoal)
 				withdrawal -= useCash
 				self.cash -= useCash
-				msg = msg + "using {:,.2f} excess cash; ".format(useCash)
+				msg = msg + "using {:,.2f} excess cash; "
+				msgArgs.append(useCash)
 			sellShares = withdrawal / self.price
 			if self.cash < self.cashGoal and self.balance > (self.withdrawal + self.withdrawal / self.withdrawalRate):
 				sellShares = 2 * sellShares		# Replenish cash
@@ -219,11 +436,36 @@ class CashCushion(Simulation):
 			if sellShares > self.shares:
 				raise InsufficientFunds(self)
 			self.shares -= sellShares
-			self.Log(msg + "selling stock ({:,.2f}; {:,.2f} shares)\n".format(sellShares * self.price, sellShares))
+			self.Log(msg + "selling stock ({:,.2f}; {:,.2f} shares)\n", *msgArgs, sellShares * self.price, sellShares)
 		self.balance -= self.withdrawal
 		self.stock = self.shares * self.price
+	def SimYearBatch(self):
+		self.cashGoal = self.withdrawal * self.cushionYears
+		useCushion = self.balance < (self.withdrawal / self.withdrawalRate)
+		# Using the cash cushion
+		cushionOnly = useCushion & (self.cash >= self.withdrawal)
+		cushionSell = (self.withdrawal - self.cash) / self.price
+		# Selling stock (using any excess cash first)
+		excess = ~useCushion & (self.cash > self.cashGoal)
+		useCash = np.where(excess, np.minimum(self.withdrawal, self.cash - self.cashGoal), 0.0)
+		cash = self.cash - useCash
+		sellShares = (self.withdrawal - useCash) / self.price
+		replenish = (cash < self.cashGoal) & (self.balance > (self.withdrawal + self.withdrawal / self.withdrawalRate))
+		sellShares = np.where(replenish, 2 * sellShares, sellShares)
+		
+		sellShares = np.where(useCushion, np.where(cushionOnly, 0.0, cushionSell), sellShares)
+		failed = sellShares > self.shares
+		self.shares = np.where(cushionOnly, self.shares, self.shares - sellShares)
+		self.cash = np.where(useCushion, np.where(cushionOnly, self.cash - self.withdrawal, 0.0), cash)
+		self.balance = self.balance - self.withdrawal
+		self.stock = self.shares * self.price
+		return failed
 
 def main():
+	if opts.batch:
+		AllStock().RunBatch()
+		CashCushion().RunBatch()
+		return
 	AllStock().run()
 	#NinetyTen().run()
 	#EightyTwenty().run()
@@ -236,6 +478,8 @@ if __name__ == "__main__":
 			opts.verbose = True
 		elif arg == '-q':
 			opts.quiet = True
+		elif arg == '-b':
+			opts.batch = True
 		elif arg[0:3] == '-y=':
 			opts.years = int(arg[3:])
 		elif arg[0:3] == '-r=':
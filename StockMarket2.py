@@ -1,10 +1,28 @@
 #!python3
 
 import itertools
+import copy
+import functools
 from collections import namedtuple
 import csv
 import datetime
-import statistics
+import math
+import os
+import json
+import time
+import collections
+import collections.abc
+import contextlib
+import cProfile
+import pstats
+import tracemalloc
+import pickle
+import hashlib
+import inspect
+import weakref
+from multiprocessing import shared_memory
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 
 # See also more_itertools.windowed
 def subranges(iterable, length):
@@ -46,6 +64,52 @@ def subranges(iterable, length):
         subrange = subrange[1:] + (item,)
         yield subrange
 
+#
+# A window onto the items of a sequence at the indexes in a range, without
+# copying them.  Creating or slicing a SequenceWindow is O(1) (slicing just
+# slices the range); indexing it indexes the underlying sequence.
+#
+class SequenceWindow(collections.abc.Sequence):
+    __slots__ = ('sequence', 'indexes')
+
+    def __init__(self, sequence, indexes):
+        self.sequence = sequence
+        self.indexes = indexes
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return SequenceWindow(self.sequence, self.indexes[key])
+        return self.sequence[self.indexes[key]]
+
+    def __iter__(self):
+        return map(self.sequence.__getitem__, self.indexes)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.indexes!r})'
+
+def sliding_windows(sequence, length, stride=1):
+    '''
+    Yield a window onto each run of @length consecutive items of @sequence,
+    taking every @stride'th item.  Unlike subranges, nothing is copied:
+    the windows of a MarketSeries are views of its arrays, and the windows
+    of any other sequence are SequenceWindows.
+
+    >>> for w in sliding_windows("abcdefg", 5, 2):
+    ...     print(w, ''.join(w))
+    SequenceWindow(range(0, 5, 2)) ace
+    SequenceWindow(range(1, 6, 2)) bdf
+    SequenceWindow(range(2, 7, 2)) ceg
+    '''
+    if isinstance(sequence, MarketSeries):
+        for start in range(len(sequence) - length + 1):
+            yield sequence.window(start, length, stride)
+    else:
+        for start in range(len(sequence) - length + 1):
+            yield SequenceWindow(sequence, range(start, start + length, stride))
+
 #
 # Access and manipulate historical stock market data.
 # See http://www.irrationalexuberance.com/
@@ -138,13 +202,364 @@ def read_tbills(fn='TB3MS.csv'):
             except ValueError:
                 continue
 
-def read_market_data():
-    MarketData = namedtuple('MarketData', 'date close dividend CPI interest')
-    shiller = read_shiller()
-    tbills = dict(read_tbills())
+def read_market_data(shiller_fn="ie_data-2.csv", tbills_fn="TB3MS.csv"):
+    MarketData = namedtuple('MarketData', 'date close dividend CPI interest GS10')
+    shiller = read_shiller(shiller_fn)
+    tbills = dict(read_tbills(tbills_fn))
     for i in shiller:
         interest = tbills.get(i.date, 0.0)
-        yield MarketData(i.date, i.close, i.dividend, i.CPI, interest)
+        yield MarketData(i.date, i.close, i.dividend, i.CPI, interest, i.GS10)
+
+#
+# A compact, columnar alternative to a list of namedtuples (such as the
+# output of read_shiller, read_yahoo or read_market_data).
+#
+# Each column is a float64 array (missing values are NaN), and the dates
+# are stored as an integer index: months since year 0 (year*12 + month-1)
+# for monthly data, or the date's ordinal for daily data.  Slicing a
+# MarketSeries (including with a step) returns a MarketSeries of views
+# into the same arrays; nothing is copied.
+#
+# Iterating over a MarketSeries yields namedtuples with a date field plus
+# one field per column, so it can be used wherever a sequence of market
+# data tuples is expected.
+#
+class MarketSeries(object):
+    def __init__(self, index, columns, unit='month'):
+        assert unit in ('month', 'day')
+        self.index = np.asarray(index, dtype=np.int64)
+        self.columns = {name: np.asarray(values, dtype=np.float64) for name, values in columns.items()}
+        self.unit = unit
+        self.Row = _series_row_type(tuple(self.columns))
+
+    @classmethod
+    def from_records(cls, records, unit='month'):
+        '''
+        Build a MarketSeries from namedtuples with a date field followed by
+        numeric fields.  None values become NaN.
+        '''
+        records = iter(records)
+        first = next(records)
+        fields = first._fields[1:]
+        dates = []
+        values = [[] for field in fields]
+        for record in itertools.chain([first], records):
+            dates.append(record[0])
+            for column, value in zip(values, record[1:]):
+                column.append(np.nan if value is None else value)
+        if unit == 'month':
+            index = [d.year * 12 + d.month - 1 for d in dates]
+        else:
+            index = [d.toordinal() for d in dates]
+        return cls(index, dict(zip(fields, values)), unit)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['columns'][name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return MarketSeries(self.index[key],
+                                {name: values[key] for name, values in self.columns.items()},
+                                self.unit)
+        values = (float(column[key]) for column in self.columns.values())
+        return self.Row(self.date(int(self.index[key])),
+                        *(None if math.isnan(value) else value for value in values))
+
+    def __iter__(self):
+        dates = self.dates
+        values = [np.where(np.isnan(v), None, v).tolist() if np.isnan(v).any() else v.tolist()
+                  for v in self.columns.values()]
+        return map(self.Row._make, zip(dates, *values))
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({len(self)} {self.unit}s, columns={list(self.columns)})'
+
+    def __reduce__(self):
+        # The Row type is created on the fly, so it can't be pickled by reference
+        return (MarketSeries, (self.index, self.columns, self.unit))
+
+    def date(self, index):
+        if self.unit == 'month':
+            return datetime.date(index // 12, index % 12 + 1, 1)
+        else:
+            return datetime.date.fromordinal(index)
+
+    @property
+    def dates(self):
+        return [self.date(i) for i in self.index.tolist()]
+
+    def window(self, start, length, stride=1):
+        # A view of @length rows starting at @start, taking every @stride'th row
+        return self[start:start+length:stride]
+
+    def trimmed(self):
+        # Get rid of any trailing market data that is incomplete
+        complete = ~(np.isnan(self.columns['dividend']) | np.isnan(self.columns['CPI']))
+        end = len(complete)
+        while end > 0 and not complete[end-1]:
+            end -= 1
+        return self[:end]
+
+_series_row_types = {}
+def _series_row_type(fields):
+    if fields not in _series_row_types:
+        _series_row_types[fields] = namedtuple('MarketSeriesRow', ('date',) + fields)
+    return _series_row_types[fields]
+
+def market_series(market_data):
+    '''
+    Convert the output of read_market_data to a MarketSeries (if it isn't
+    already one), with trailing incomplete data removed.
+    '''
+    if not isinstance(market_data, MarketSeries):
+        market_data = MarketSeries.from_records(market_data)
+    return market_data.trimmed()
+
+def synthetic_series(months, seed=0):
+    '''
+    A MarketSeries of @months of random, but plausible, monthly market data
+    starting in January 1900, with the columns of read_market_data plus
+    GS10.  Used by the examples below, which compare the engines with each
+    other and shouldn't depend on the CSV files.  The same @seed gives the
+    same data.
+
+    >>> synthetic_series(240)
+    MarketSeries(240 months, columns=['close', 'dividend', 'CPI', 'interest', 'GS10'])
+    '''
+    rng = np.random.default_rng(seed)
+    close = 100.0 * np.cumprod(1.0 + rng.normal(0.005, 0.045, months))
+    return MarketSeries(1900 * 12 + np.arange(months), {
+        'close': close,
+        'dividend': close * rng.uniform(0.02, 0.05, months),
+        'CPI': 10.0 * np.cumprod(1.0 + rng.normal(0.0025, 0.004, months)),
+        'interest': rng.uniform(0.0, 0.06, months),
+        'GS10': rng.uniform(2.0, 8.0, months)})
+
+#
+# Cache the parsed contents of the CSV files as binary .npy files in a
+# __marketcache__ directory next to the source file, so that later loads
+# just memory-map the arrays instead of parsing text.
+#
+# The cache is keyed on the reader's name plus the path, size and
+# modification time of each source file; if any of them change, the data
+# is parsed again and the cache rewritten (as it is after a change to
+# CACHE_VERSION).  The .npy file holds a 2-D array whose first row is the
+# MarketSeries index and whose other rows are the columns, so each column
+# is a contiguous view.  The column names and key are in a .json file
+# alongside it.
+#
+CACHE_DIR = '__marketcache__'
+
+CACHE_VERSION = 2      # Increase when a reader's columns change
+
+def cached_series(reader, *sources, unit='month'):
+    key = {'reader': reader.__name__, 'version': CACHE_VERSION, 'unit': unit, 'sources': []}
+    for source in sources:
+        stat = os.stat(source)
+        key['sources'].append([os.path.abspath(source), stat.st_size, stat.st_mtime_ns])
+
+    directory = os.path.join(os.path.dirname(os.path.abspath(sources[0])), CACHE_DIR)
+    base = os.path.join(directory, f'{reader.__name__}-{os.path.basename(sources[0])}')
+    try:
+        with open(base + '.json') as f:
+            info = json.load(f)
+        if info['key'] == key:
+            data = np.load(base + '.npy', mmap_mode='r')
+            return MarketSeries(data[0].astype(np.int64),
+                                dict(zip(info['columns'], data[1:])), unit)
+    except (OSError, ValueError, KeyError):
+        pass
+
+    series = MarketSeries.from_records(reader(*sources), unit)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        data = np.vstack([series.index.astype(np.float64)] + list(series.columns.values()))
+        np.save(base + '.tmp.npy', data)
+        os.replace(base + '.tmp.npy', base + '.npy')
+        with open(base + '.tmp.json', 'w') as f:
+            json.dump({'key': key, 'columns': list(series.columns)}, f)
+        os.replace(base + '.tmp.json', base + '.json')
+    except OSError:
+        pass        # Not being able to write the cache is harmless
+    return series
+
+def load_shiller(fn="ie_data-2.csv"):
+    return cached_series(read_shiller, fn)
+
+def load_yahoo(fn='^GSPC.csv'):
+    return cached_series(read_yahoo, fn, unit='day')
+
+def load_market_data(shiller_fn="ie_data-2.csv", tbills_fn="TB3MS.csv"):
+    '''
+    Load the output of read_market_data.  If @tbills_fn is None or doesn't
+    exist, cash earns no interest (as read_market_data does for months
+    without a T-bill rate).
+    '''
+    if tbills_fn is not None and os.path.exists(tbills_fn):
+        return cached_series(read_market_data, shiller_fn, tbills_fn)
+    shiller = load_shiller(shiller_fn)
+    return MarketSeries(shiller.index,
+                        {'close': shiller.close, 'dividend': shiller.dividend,
+                         'CPI': shiller.CPI, 'interest': np.zeros(len(shiller)), 'GS10': shiller.GS10})
+
+#
+# Publish a MarketSeries in shared memory, so that worker processes can
+# use it without parsing the CSV files or unpickling a copy of the data.
+#
+#   with SharedMarketSeries(series) as shared:
+#       pool = ProcessPoolExecutor(initializer=..., initargs=(shared.handle,))
+#
+# Workers call attach_series(shared.handle) to get a read-only MarketSeries
+# whose arrays live in the shared segment.  The segment is unlinked when
+# the SharedMarketSeries is closed, garbage collected, or at interpreter
+# exit, whichever comes first.  Only the process that published the data
+# should close it.
+#
+SharedSeriesHandle = namedtuple('SharedSeriesHandle', 'name length columns unit')
+
+class SharedMarketSeries(object):
+    def __init__(self, series):
+        length = len(series)
+        columns = list(series.columns)
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, 8 * length * (len(columns) + 1)))
+        self._finalizer = weakref.finalize(self, _release_shared_memory, self.shm)
+        index, values = _shared_arrays(self.shm, length, len(columns))
+        index[:] = series.index
+        for row, name in zip(values, columns):
+            row[:] = series.columns[name]
+        self.handle = SharedSeriesHandle(self.shm.name, length, columns, series.unit)
+
+    def close(self):
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def _release_shared_memory(shm):
+    shm.close()
+    shm.unlink()
+
+def _shared_arrays(shm, length, num_columns):
+    index = np.ndarray((length,), dtype=np.int64, buffer=shm.buf)
+    values = np.ndarray((num_columns, length), dtype=np.float64, buffer=shm.buf, offset=8 * length)
+    return index, values
+
+_attached_series = {}
+def attach_series(handle):
+    '''
+    Return a read-only MarketSeries backed by the shared memory described by
+    @handle (see SharedMarketSeries).  Repeated calls in the same process
+    return the same MarketSeries.
+    '''
+    if handle.name not in _attached_series:
+        shm = shared_memory.SharedMemory(name=handle.name)
+        index, values = _shared_arrays(shm, handle.length, len(handle.columns))
+        index.setflags(write=False)
+        values.setflags(write=False)
+        series = MarketSeries(index, dict(zip(handle.columns, values)), handle.unit)
+        series.shm = shm        # Keep the segment mapped as long as the series is alive
+        _attached_series[handle.name] = series
+    return _attached_series[handle.name]
+
+#
+# Generate synthetic market histories by block bootstrapping the monthly
+# historical data: each path is made of blocks of @block_length consecutive
+# historical months, picked at random (with replacement).  Within a month,
+# the price change, CPI change, dividend yield and interest rate all come
+# from the same historical month, so their correlations are preserved, as
+# are any correlations within a block.
+#
+# Paths start at a price and CPI of 1.0 (only ratios matter to Portfolio).
+# Given the same @seed, the same paths are generated.
+#
+ScenarioPaths = namedtuple('ScenarioPaths', 'close dividend CPI interest')
+AllocationPaths = namedtuple('AllocationPaths', ScenarioPaths._fields + ('bonds',))    # See AllocationPortfolio
+
+class BlockBootstrap(object):
+    def __init__(self, market_data, block_length=60, seed=None):
+        series = market_series(market_data)
+        close = series.close
+        self.series = series
+        self.block_length = block_length
+        self.price_change = close[1:] / close[:-1]
+        self.cpi_change = series.CPI[1:] / series.CPI[:-1]
+        self.dividend_yield = series.dividend[:-1] / close[:-1]
+        self.interest = series.columns.get('interest', np.zeros(len(series)))[:-1]
+        self.rng = np.random.default_rng(seed)
+
+    def months(self, num_paths, period_length):
+        # Historical month numbers for each path: a (num_paths x period_length) array
+        num_blocks = -(-period_length // self.block_length)
+        starts = self.rng.integers(0, len(self.price_change) - self.block_length + 1,
+                                   size=(num_paths, num_blocks))
+        months = starts[:, :, np.newaxis] + np.arange(self.block_length)
+        return months.reshape(num_paths, -1)[:, :period_length]
+
+    def paths(self, num_paths, period_length, stride=1):
+        # Returns ScenarioPaths of (ticks x num_paths) arrays, where the ticks
+        # are every @stride'th month of @period_length months.
+        return self.scenario(self.months(num_paths, period_length).T, stride)
+
+    def allocation_paths(self, bonds, num_paths, period_length, stride=1):
+        # Like paths, but returns AllocationPaths, which also have the
+        # levels of @bonds (a monthly total return index, as from
+        # bond_index) over the same months
+        months = self.months(num_paths, period_length).T
+        return AllocationPaths(*self.scenario(months, stride),
+                               self.levels(bonds[1:] / bonds[:-1], months, stride))
+
+    def scenario(self, months, stride):
+        # The ScenarioPaths for a (period_length x num_paths) array of @months
+        months_ticks = months[::stride]
+        close = self.levels(self.price_change, months, stride)
+        return ScenarioPaths(close, self.dividend_yield[months_ticks] * close,
+                             self.levels(self.cpi_change, months, stride), self.interest[months_ticks])
+
+    @staticmethod
+    def levels(changes, months, stride):
+        # Month 0 is 1.0; each later month applies the prior month's change.
+        # @changes may have leading axes (such as one per asset).
+        result = np.ones(changes.shape[:-1] + months.shape)
+        np.cumprod(changes[..., months[:-1]], axis=-2, out=result[..., 1:, :])
+        return result[..., ::stride, :]
+
+# Get rid of any trailing market data that is incomplete
+def trim_market_data(market_data):
+    if isinstance(market_data, MarketSeries):
+        return market_data.trimmed()
+    market_data = list(market_data)
+    while market_data[-1].dividend is None or market_data[-1].CPI is None:
+        del market_data[-1]
+    return market_data
+
+def round_cents(values):
+    '''
+    Round an array of dollar amounts to cents, giving exactly the same
+    results as the builtin round(value, 2).
+
+    numpy.round scales by 100 and rounds half to even, which can disagree
+    with round() when the scaled value lands on (or within an ulp of) a
+    half cent.  Those rare values are rounded individually with round().
+
+    >>> round_cents([2.675, 1.005, 0.125, 1234.5678]).tolist()
+    [2.67, 1.0, 0.12, 1234.57]
+    '''
+    values = np.asarray(values, dtype=float)
+    scaled = values * 100.0
+    result = np.rint(scaled) / 100.0        # Exactly what np.round(values, 2) computes
+    ties = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    if ties.any():
+        result[ties] = [round(value, 2) for value in values[ties].tolist()]
+    return result
 
 class Decline(namedtuple('Decline', 'peak trough recovery percent')):
     def summarize(self):
@@ -182,6 +597,186 @@ def declines(market_data_seq):
     except StopIteration:
         pass
 
+#
+# Drawdown analytics for a whole MarketSeries at once, using array
+# operations instead of the tick-by-tick loop in declines().
+#
+#   running_max     highest close so far, at each tick
+#   depth           fraction below running_max, at each tick
+#   peak, trough, recovery
+#                   indexes into the series of each decline, exactly as
+#                   declines() would find them (including zero-percent
+#                   declines where the close repeats a peak)
+#   percent         size of each decline, (peak - trough) / peak
+#   duration        ticks from peak to recovery
+#
+# With real=True, the closes are first converted to today's dollars using
+# the series' CPI column (so the series must not have trailing missing
+# CPI values; see MarketSeries.trimmed).
+#
+class Drawdowns(namedtuple('Drawdowns', 'running_max depth peak trough recovery percent duration')):
+    def declines(self, series, real=False):
+        # The same declines as a list of Decline, with PriceTick's
+        close = _drawdown_prices(series, real)
+        dates = series.dates
+        def tick(i):
+            return PriceTick(dates[i], float(close[i]))
+        return [Decline(tick(p), tick(t), tick(r), percent)
+                for p, t, r, percent in zip(self.peak.tolist(), self.trough.tolist(),
+                                            self.recovery.tolist(), self.percent.tolist())]
+
+def _drawdown_prices(series, real):
+    if real:
+        return series.close * series.CPI[-1] / series.CPI
+    return series.close
+
+def drawdowns(series, real=False, min_percent=0.0):
+    '''
+    >>> series = synthetic_series(600)
+    >>> summary = lambda d: (d.peak[:2], d.trough[:2], d.recovery[:2], d.percent)
+    >>> ([summary(d) for d in drawdowns(series).declines(series)] ==
+    ...  [summary(d) for d in declines(series)])
+    True
+    '''
+    close = _drawdown_prices(series, real)
+    running_max = np.maximum.accumulate(close)
+    depth = 1.0 - close / running_max
+
+    # Peaks and recoveries are the ticks that reach (or tie) the previous
+    # high.  Each decline runs from one of those to the next, and happens
+    # if there is a gap between them, or if the close just repeats the high.
+    highs = np.flatnonzero(np.concatenate(([True], close[1:] >= running_max[:-1])))
+    peak, recovery = highs[:-1], highs[1:]
+    is_decline = (recovery > peak + 1) | (close[recovery] == close[peak])
+    peak, recovery = peak[is_decline], recovery[is_decline]
+
+    # The trough is the first lowest close after the peak and before the
+    # recovery (or the recovery itself, when they are adjacent)
+    gap = recovery > peak + 1
+    trough = recovery.copy()
+    if gap.any():
+        # Label the ticks inside each gap with the gap's number, then take
+        # the first position of each gap's minimum
+        segment_starts = peak[gap] + 1
+        segment = np.zeros(len(close), dtype=np.int64)
+        within = np.zeros(len(close) + 1, dtype=np.int64)
+        within[segment_starts] += 1
+        within[recovery[gap]] -= 1
+        inside = np.cumsum(within)[:-1] > 0
+        segment[segment_starts[1:]] = 1
+        segment = np.cumsum(segment)
+        lows = np.minimum.reduceat(np.where(inside, close, np.inf), segment_starts)
+        positions = np.where(inside & (close == lows[segment]), np.arange(len(close)), len(close))
+        trough[gap] = np.minimum.reduceat(positions, segment_starts)
+
+    percent = (close[peak] - close[trough]) / close[peak]
+    keep = percent >= min_percent
+    peak, trough, recovery, percent = peak[keep], trough[keep], recovery[keep], percent[keep]
+    return Drawdowns(running_max, depth, peak, trough, recovery, percent, recovery - peak)
+
+#
+# Like declines(read_yahoo(fn)), but reads only the date and close columns
+# of the CSV file, in large chunks, and keeps only the current peak and
+# trough as it goes, so memory use doesn't depend on the size of the file.
+# Dates are only parsed for the declines that are reported, i.e., those of
+# at least @min_percent.  The peak, trough and recovery are PriceTicks,
+# whose date is a datetime.date, or a datetime.datetime for intraday rows
+# with a time ("2020-01-02 09:30:00", or any other ISO 8601 form).
+#
+PriceTick = namedtuple('PriceTick', 'date close')
+
+def stream_declines(fn='^GSPC.csv', min_percent=0.0,
+                    date_column='Date', close_column='Close', chunk_size=1<<20):
+    '''
+    >>> import tempfile
+    >>> series = synthetic_series(600)
+    >>> with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+    ...     print('Date,Close', file=f)
+    ...     for row in series:
+    ...         print(f'{row.date},{row.close!r}', file=f)
+    >>> streamed = list(stream_declines(f.name, min_percent=0.05, chunk_size=1000))
+    >>> os.remove(f.name)
+    >>> summary = lambda d: (d.peak[:2], d.trough[:2], d.recovery[:2], d.percent)
+    >>> ([summary(d) for d in streamed] ==
+    ...  [summary(d) for d in declines(series) if d.percent >= 0.05])
+    True
+
+    Intraday rows, with a time of day:
+
+    >>> start = datetime.datetime(2020, 1, 2, 9, 30)
+    >>> minutes = [PriceTick(start + datetime.timedelta(minutes=i), row.close) for i, row in enumerate(series)]
+    >>> with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+    ...     print('Date,Close', file=f)
+    ...     for row in minutes:
+    ...         print(f'{row.date},{row.close!r}', file=f)
+    >>> streamed = list(stream_declines(f.name, min_percent=0.05, chunk_size=1000))
+    >>> os.remove(f.name)
+    >>> streamed[0].peak.date
+    datetime.datetime(2020, 1, 2, 9, 37)
+    >>> ([summary(d) for d in streamed] ==
+    ...  [summary(d) for d in declines(minutes) if d.percent >= 0.05])
+    True
+    '''
+    def tick(date, close):
+        return PriceTick(_parse_timestamp(date), close)
+
+    peak_date = None
+    trough_date = None
+    for date, close in _read_date_close(fn, date_column, close_column, chunk_size):
+        if peak_date is None:
+            peak_date, peak_close = date, close
+            continue
+        if trough_date is None:
+            if close > peak_close:
+                peak_date, peak_close = date, close
+                continue
+            trough_date, trough_close = date, close
+        if close < peak_close:
+            if close < trough_close:
+                trough_date, trough_close = date, close
+            continue
+
+        # Recovered; this is the peak before the next decline
+        percent = (peak_close - trough_close) / peak_close
+        if percent >= min_percent:
+            yield Decline(tick(peak_date, peak_close), tick(trough_date, trough_close),
+                          tick(date, close), percent)
+        peak_date, peak_close = date, close
+        trough_date = None
+
+def _parse_timestamp(text):
+    # A date for date-only text, or else a datetime
+    if len(text) == 10:
+        return datetime.date.fromisoformat(text)
+    return datetime.datetime.fromisoformat(text)
+
+def _read_date_close(fn, date_column, close_column, chunk_size):
+    # Yield (date string, close) for each row of the CSV file @fn, skipping
+    # rows whose close isn't a number (e.g., "null").
+    with open(fn, mode='r') as f:
+        headers = f.readline().rstrip('\n').split(',')
+        date_index = headers.index(date_column)
+        close_index = headers.index(close_column)
+        partial = ''
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            lines = (partial + chunk).split('\n')
+            partial = lines.pop()
+            for line in lines:
+                fields = line.split(',')
+                try:
+                    yield fields[date_index], float(fields[close_index])
+                except (ValueError, IndexError):
+                    continue
+        if partial:
+            fields = partial.split(',')
+            try:
+                yield fields[date_index], float(fields[close_index])
+            except (ValueError, IndexError):
+                pass
+
 #
 # For now, maintains its entire balance in shares of stock
 #
@@ -199,6 +794,66 @@ def declines(market_data_seq):
 # Note: the balance item is the balance after the withdrawal and dividend
 PortfolioHistoryItem = namedtuple('PortfolioHistoryItem', 'date withdrawal balance stock_price cpi')
 
+HISTORY_MODES = ('full', 'sampled', 'none')
+
+#
+# The parts of a period's history needed to summarize it.  The "real"
+# values are balances in dollars as of the start of the period.
+#
+PeriodEndpoints = namedtuple('PeriodEndpoints', 'first_balance first_withdrawal first_cpi '\
+                                                'last_balance last_withdrawal last_cpi '\
+                                                'real_min real_max real_last')
+
+def batch_endpoint_columns(lengths, balances, withdrawals, cpis):
+    '''
+    Return a PeriodEndpoints of arrays, with one element per lane, from the
+    output of Portfolio.simulate_paths and the matching (lanes x ticks) CPI
+    values.
+
+    The balances after a lane fails are NaN (as simulate_paths leaves
+    them), so fmin and fmax over a lane's row skip them.
+    '''
+    lanes, ticks = balances.shape
+    real = balances * cpis[:, :1] / cpis
+    last = lengths - 1
+    lane_numbers = np.arange(lanes)
+    started = lengths > 0
+    return PeriodEndpoints(
+        balances[:, 0], withdrawals[:, 0], cpis[:, 0],
+        balances[lane_numbers, last], withdrawals[lane_numbers, last], cpis[lane_numbers, last],
+        np.where(started, np.fmin.reduce(real, axis=1), np.inf),
+        np.where(started, np.fmax.reduce(real, axis=1), -np.inf),
+        real[lane_numbers, last])
+
+def batch_endpoints(lengths, balances, withdrawals, cpis):
+    '''
+    Like batch_endpoint_columns, but returns a list of PeriodEndpoints, one per lane.
+    '''
+    columns = batch_endpoint_columns(lengths, balances, withdrawals, cpis)
+    return list(map(PeriodEndpoints._make, zip(*(column.tolist() for column in columns))))
+
+# Computes PeriodEndpoints' fields on the fly, one tick at a time
+class PeriodStats(object):
+    __slots__ = PeriodEndpoints._fields
+
+    def add(self, withdrawal, balance, cpi):
+        try:
+            real = balance * self.first_cpi / cpi
+        except AttributeError:
+            self.first_balance = balance
+            self.first_withdrawal = withdrawal
+            self.first_cpi = cpi
+            real = balance * cpi / cpi
+            self.real_min = self.real_max = real
+        if real < self.real_min:
+            self.real_min = real
+        if real > self.real_max:
+            self.real_max = real
+        self.real_last = real
+        self.last_balance = balance
+        self.last_withdrawal = withdrawal
+        self.last_cpi = cpi
+
 PeriodsResult = namedtuple('PeriodsResult', [
     'survivability', 'sustainability',
     'balance_cgr_median', 'balance_cgr_mean', 'balance_cgr_std',
@@ -210,6 +865,547 @@ Period = namedtuple('Period', 'date survived sustained '\
                               'last_withdrawal_rate '\
                               'history')
 
+#
+# The periods of a PeriodsResult, stored by column: one array per Period
+# field, plus (unless the history mode is 'none') the (periods x ticks)
+# matrices of balances and withdrawals, which are NaN after a period fails.
+#
+# It is still a sequence of Period namedtuples, but they are only created
+# when accessed, and a Period's history is built from the matrices when
+# that Period is created.  to_numpy() and to_pandas() give the columns
+# without building any Periods (or copying the arrays).
+#
+#   periods = Portfolio().sim_periods_batch(market_data).periods
+#   failed = periods.start_dates()[~periods.survived]
+#
+class PeriodTable(collections.abc.Sequence):
+    COLUMNS = Period._fields[1:-1]      # Everything but date and history
+
+    def __init__(self, starts, columns, series=None, history='none', windows=None,
+                 balances=None, withdrawals=None, lengths=None, histories=None, sample=1):
+        self.starts = starts            # Period.date; an index into @series if there is one
+        self.columns = columns          # Field name -> array, for COLUMNS
+        self.series = series            # The MarketSeries the periods come from, if any
+        self.history = history          # The history mode; see simulate_withdrawals
+        self.windows = windows          # (periods x ticks) indexes of each tick's row in @series
+        self.balances = balances        # (periods x ticks) balance after each tick
+        self.withdrawals = withdrawals  # (periods x ticks) withdrawal at each tick
+        self.lengths = lengths          # Valid ticks of each period
+        self.histories = histories      # Already built histories (from the scalar engine)
+        self.sample = sample            # Ticks per sample in 'sampled' history mode
+        self.summary = None             # The PeriodsSummary, set by Portfolio.summarize_periods
+
+    @classmethod
+    def from_periods(cls, periods, history='none'):
+        # Build a PeriodTable from a list of Periods, whose history is as per @history
+        columns = {field: np.array([getattr(period, field) for period in periods])
+                   for field in cls.COLUMNS}
+        histories = [period.history for period in periods]
+        balances = withdrawals = lengths = None
+        if histories and all(history is not None for history in histories):
+            lengths = np.array([len(history) for history in histories])
+            balances = np.full((len(histories), lengths.max(initial=0)), np.nan)
+            withdrawals = balances.copy()
+            for row, history in enumerate(histories):
+                balances[row, :len(history)] = [item.balance for item in history]
+                withdrawals[row, :len(history)] = [item.withdrawal for item in history]
+        return cls(np.array([period.date for period in periods], dtype=object), columns,
+                   history=history, balances=balances, withdrawals=withdrawals, lengths=lengths, histories=histories)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['columns'][name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[i] for i in range(*key.indices(len(self)))]
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError('PeriodTable index out of range')
+        values = (self.columns[field][key].item() for field in self.COLUMNS)
+        return Period(self.date(key), *values, self.period_history(key))
+
+    def __iter__(self):
+        columns = [self.columns[field].tolist() for field in self.COLUMNS]
+        for i, values in enumerate(zip(*columns)):
+            yield Period(self.date(i), *values, self.period_history(i))
+
+    def __eq__(self, other):
+        if not isinstance(other, collections.abc.Sequence):
+            return NotImplemented
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({len(self)} periods, history={self.history!r})'
+
+    def date(self, i):
+        start = self.starts[i]
+        if self.series is None:
+            return start.item() if isinstance(start, np.generic) else start
+        return self.series.date(int(self.series.index[start]))
+
+    def period_history(self, i):
+        # The history of period @i (a list of PortfolioHistoryItem), or None
+        if self.histories is not None:
+            return self.histories[i]
+        if self.history == 'none':
+            return None
+        length = int(self.lengths[i])
+        if self.history == 'full':
+            picks = np.arange(length)
+        else:
+            picks = np.union1d(np.arange(0, length, self.sample), [length - 1])
+        rows = self.windows[i, picks]
+        series = self.series
+        return list(map(PortfolioHistoryItem._make, zip(
+            [series.date(index) for index in series.index[rows].tolist()],
+            self.withdrawals[i, picks].tolist(),
+            self.balances[i, picks].tolist(),
+            series.close[rows].tolist(),
+            series.CPI[rows].tolist())))
+
+    def to_numpy(self):
+        # A dict of the Period fields (other than history) as arrays.  The
+        # dates are the datetime64 start dates if the periods come from a
+        # MarketSeries, or else Period.date.
+        return {'date': self.start_dates(), **self.columns}
+
+    def start_dates(self):
+        if self.series is None:
+            return self.starts
+        index = self.series.index[self.starts]
+        if self.series.unit == 'month':
+            return (index - 1970 * 12).astype('datetime64[M]')
+        return (index - datetime.date(1970, 1, 1).toordinal()).astype('datetime64[D]')
+
+    def to_pandas(self, values='periods'):
+        '''
+        Return a pandas DataFrame indexed by start date, of the Period
+        fields (other than history) if @values is 'periods', or of the
+        'balances' or 'withdrawals' matrix (one column per tick).
+        '''
+        import pandas as pd
+        index = pd.Index(self.start_dates(), name='date')
+        if values == 'periods':
+            return pd.DataFrame(self.columns, index=index, copy=False)
+        return pd.DataFrame(getattr(self, values), index=index, copy=False)
+
+#
+# Approximate quantiles of a stream of values, added in chunks (arrays),
+# in bounded memory.  This is a simplified KLL sketch: level i holds values
+# that each stand for 2**i of the original values.  When a level holds
+# more than @capacity values, they are sorted and every other one (from a
+# random start) is promoted to the next level.  Until that first happens,
+# the quantiles are exact; after, their rank error is a small fraction of
+# a percentile for a capacity in the thousands.
+#
+class QuantileSketch(object):
+    def __init__(self, capacity=10000, seed=0):
+        self.capacity = capacity
+        self.levels = [np.empty(0)]
+        self.rng = np.random.default_rng(seed)
+
+    def add(self, values):
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        level = 0
+        while len(self.levels[level]) > self.capacity:
+            items = np.sort(self.levels[level])
+            odd = len(items) % 2            # An odd one out stays at this level
+            if level + 1 == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[level+1] = np.concatenate([self.levels[level+1],
+                                                   items[odd + self.rng.integers(2)::2]])
+            self.levels[level] = items[:odd]
+            level += 1
+
+    def quantile(self, q):
+        # The @q quantile (0 <= q <= 1), interpolated like np.quantile
+        if len(self.levels) == 1:
+            if q == 0.5:
+                return float(np.median(self.levels[0]))
+            return float(np.quantile(self.levels[0], q))
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(items), 2.0 ** level)
+                                  for level, items in enumerate(self.levels)])
+        order = np.argsort(values, kind='stable')
+        values, weights = values[order], weights[order]
+        ranks = (np.cumsum(weights) - weights / 2) / weights.sum()
+        return float(np.interp(q, ranks, values))
+
+#
+# One-pass count, mean, variance, min, max and quantiles of a stream of
+# values, added in chunks.  Each chunk's mean and sum of squared
+# differences are combined with the running ones using Welford's method
+# (in the pairwise form of Chan et al), so the data is only scanned once.
+#
+class RunningStats(object):
+    def __init__(self, capacity=10000):
+        self.count = 0
+        self.mean = math.nan
+        self.m2 = 0.0               # Sum of squared differences from the mean
+        self.min = math.inf
+        self.max = -math.inf
+        self.sketch = QuantileSketch(capacity)
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        n = len(values)
+        if n == 0:
+            return
+        mean = float(values.mean())
+        m2 = float(np.square(values - mean).sum())
+        if self.count == 0:
+            self.mean, self.m2 = mean, m2
+        else:
+            total = self.count + n
+            delta = mean - self.mean
+            self.mean += delta * n / total
+            self.m2 += m2 + delta * delta * self.count * n / total
+        self.count += n
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self.sketch.add(values)
+
+    @property
+    def variance(self):
+        # Sample variance, like statistics.variance
+        return self.m2 / (self.count - 1) if self.count > 1 else math.nan
+
+    @property
+    def stdev(self):
+        return math.sqrt(self.variance)
+
+    def quantile(self, q):
+        return self.sketch.quantile(q) if self.count else math.nan
+
+    def median(self):
+        return self.quantile(0.5)
+
+#
+# The summary of a set of periods, accumulated in one pass over chunks of
+# PeriodTable columns: survival and sustain counts, plus RunningStats of
+# the real balance and withdrawal growth rates of the periods that
+# survived.  result() gives the PeriodsResult; percentiles() gives the
+# PERCENTILES of the growth rates.
+#
+# A statistic that can't be computed is NaN rather than an error (unlike
+# the statistics module, which sim_periods used to raise StatisticsError
+# from): the mean, median and percentiles when no period survived, the
+# standard deviation when fewer than two did, and the withdrawal growth
+# rates when the first withdrawal is zero.
+#
+class PeriodsSummary(object):
+    PERCENTILES = (5, 10, 90)
+    PERCENTILE_FIELDS = ('balance_cgr_p5', 'balance_cgr_p10', 'balance_cgr_p90',
+                         'withdrawal_cgr_p5', 'withdrawal_cgr_p10', 'withdrawal_cgr_p90')
+
+    def __init__(self, capacity=10000):
+        self.periods = 0
+        self.survived = 0
+        self.sustained = 0
+        self.balance_cgr = RunningStats(capacity)
+        self.withdrawal_cgr = RunningStats(capacity)
+
+    def add(self, columns):
+        # @columns maps PeriodTable.COLUMNS to arrays
+        survived = columns['survived']
+        self.periods += len(survived)
+        self.survived += int(np.count_nonzero(survived))
+        self.sustained += int(np.count_nonzero(columns['sustained']))
+        self.balance_cgr.add(columns['growth_rate_real'][survived])
+        self.withdrawal_cgr.add(columns['withdrawal_rate_real'][survived])
+
+    def result(self, periods):
+        return PeriodsResult(self.survived / self.periods, self.sustained / self.periods,
+            self.balance_cgr.median(), self.balance_cgr.mean, self.balance_cgr.stdev,
+            self.withdrawal_cgr.median(), self.withdrawal_cgr.mean, self.withdrawal_cgr.stdev,
+            periods)
+
+    def percentiles(self):
+        return dict(zip(self.PERCENTILE_FIELDS,
+                        [stats.quantile(p / 100) for stats in (self.balance_cgr, self.withdrawal_cgr)
+                         for p in self.PERCENTILES]))
+
+#
+# Low overhead instrumentation of the simulation.
+#
+# Give a Portfolio an Instrumentation to count how often each withdrawal
+# branch and withdrawal policy rule is used (counters named like
+# "withdraw.sell" or "adjust.Ratchet"), and to time the phases of
+# sim_periods and friends ("load", "window", "simulate", "aggregate").
+# Without one (the default), the hot paths only pay for an "is None" test.
+#
+#   instrumentation = Instrumentation()
+#   with instrumentation.profile():             # Optional cProfile + tracemalloc
+#       Portfolio(instrumentation=instrumentation).sim_periods(market_data)
+#   instrumentation.write_json('profile.json')
+#
+class Instrumentation(object):
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.timings = collections.defaultdict(float)   # Total seconds per phase
+        self.profile_stats = None
+        self.memory = None
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] += time.perf_counter() - start
+
+    @contextlib.contextmanager
+    def profile(self, top=25):
+        # Run the body under cProfile and tracemalloc, and keep the @top
+        # functions (by cumulative time) and allocation sites (by size)
+        profiler = cProfile.Profile()
+        tracemalloc.start()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            stats = pstats.Stats(profiler)
+            functions = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:top]
+            self.profile_stats = [
+                {'function': f'{filename}:{line}({name})', 'calls': calls,
+                 'total_time': total_time, 'cumulative_time': cumulative_time}
+                for (filename, line, name), (primitive_calls, calls, total_time, cumulative_time, callers)
+                in functions]
+            self.memory = {'current_bytes': current, 'peak_bytes': peak,
+                           'top': [{'location': str(stat.traceback), 'bytes': stat.size, 'count': stat.count}
+                                   for stat in snapshot.statistics('lineno')[:top]]}
+
+    def merge(self, other):
+        # Add the counters and timings of @other (an Instrumentation or as_dict() result)
+        if isinstance(other, Instrumentation):
+            other = other.as_dict()
+        self.counters.update(other['counters'])
+        for name, seconds in other['timings'].items():
+            self.timings[name] += seconds
+
+    def as_dict(self):
+        result = {'counters': dict(self.counters), 'timings': dict(self.timings)}
+        if self.profile_stats is not None:
+            result['profile'] = self.profile_stats
+        if self.memory is not None:
+            result['memory'] = self.memory
+        return result
+
+    def write_json(self, fn):
+        with open(fn, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+def _phase(instrumentation, name):
+    # instrumentation.phase(name), or a no-op if instrumentation is None
+    if instrumentation is None:
+        return contextlib.nullcontext()
+    return instrumentation.phase(name)
+
+#
+# Withdrawal policies: how the withdrawal is adjusted each year.
+#
+# A WithdrawalPolicy is a list of WithdrawalRules; each year, the first rule
+# that applies determines the new period withdrawal.  If no rule applies,
+# the withdrawal is adjusted for inflation.
+#
+# Rules see a WithdrawalState.  When simulating one portfolio, its fields
+# are floats; in the batched engine they are arrays with one value per
+# portfolio (lane).  A rule implements applies() and amount() (the new
+# period withdrawal before rounding to cents); the default batch versions
+# just call the same methods with the arrays, which works for any rule
+# written with arithmetic and comparison operators.  Rules that need
+# different code for arrays (e.g., using numpy functions) can override
+# applies_batch() and amount_batch().
+#
+WithdrawalState = namedtuple('WithdrawalState', 'period_withdrawal balance cpi previous_cpi '\
+                                                'max_balance annual_maximum annual_withdrawal')
+
+class WithdrawalRule(object):
+    description = ''
+
+    def applies(self, portfolio, state):
+        raise NotImplementedError
+
+    def amount(self, portfolio, state):
+        raise NotImplementedError
+
+    def applies_batch(self, portfolio, state):
+        return self.applies(portfolio, state)
+
+    def amount_batch(self, portfolio, state):
+        return self.amount(portfolio, state)
+
+    def __repr__(self):
+        args = ', '.join(f'{name}={value!r}' for name, value in vars(self).items())
+        return f'{self.__class__.__name__}({args})'
+
+class PayCut(WithdrawalRule):
+    """If the balance is at or below @threshold of the maximum, multiply the withdrawal by @rate"""
+    description = 'pay cut'
+    def __init__(self, threshold=0.90, rate=0.97):
+        self.threshold = threshold
+        self.rate = rate
+    def applies(self, portfolio, state):
+        return state.balance <= state.max_balance * self.threshold
+    def amount(self, portfolio, state):
+        return state.period_withdrawal * self.rate
+
+class Raise(WithdrawalRule):
+    """If the balance is at least @threshold of the highest year-end balance, multiply the withdrawal by @rate"""
+    description = 'raise'
+    def __init__(self, threshold=1.10, rate=1.10):
+        self.threshold = threshold
+        self.rate = rate
+    def applies(self, portfolio, state):
+        return state.balance >= state.annual_maximum * self.threshold
+    def amount(self, portfolio, state):
+        return state.period_withdrawal * self.rate
+
+class Ratchet(WithdrawalRule):
+    """If the annual withdrawal rate has fallen below the initial rate, raise it back to the initial rate"""
+    description = 'ratchet up'
+    def applies(self, portfolio, state):
+        return state.annual_withdrawal < state.balance * portfolio.annual_withdrawal_rate
+    def amount(self, portfolio, state):
+        return state.balance * portfolio.annual_withdrawal_rate / portfolio.withdrawals_per_year
+
+class Inflation(WithdrawalRule):
+    """Adjust the withdrawal for inflation over the past year"""
+    description = '(inflation)'
+    def applies(self, portfolio, state):
+        return True
+    def amount(self, portfolio, state):
+        return state.period_withdrawal * state.cpi / state.previous_cpi
+
+class Guardrails(WithdrawalRule):
+    """
+    Guyton-Klinger style guardrails: if the current withdrawal rate is more
+    than @upper above the initial rate, cut the withdrawal by @adjustment;
+    if it is more than @lower below the initial rate, raise it by @adjustment.
+    Otherwise, the next rule (normally inflation) applies.
+    """
+    description = 'guardrail'
+    def __init__(self, upper=0.20, lower=0.20, adjustment=0.10):
+        self.upper = upper
+        self.lower = lower
+        self.adjustment = adjustment
+    def _rate(self, portfolio, state):
+        return state.annual_withdrawal / state.balance / portfolio.annual_withdrawal_rate
+    def applies(self, portfolio, state):
+        rate = self._rate(portfolio, state)
+        return (rate > 1.0 + self.upper) | (rate < 1.0 - self.lower)
+    def amount(self, portfolio, state):
+        if self._rate(portfolio, state) > 1.0 + self.upper:
+            return state.period_withdrawal * (1.0 - self.adjustment)
+        return state.period_withdrawal * (1.0 + self.adjustment)
+    def amount_batch(self, portfolio, state):
+        return np.where(self._rate(portfolio, state) > 1.0 + self.upper,
+                        state.period_withdrawal * (1.0 - self.adjustment),
+                        state.period_withdrawal * (1.0 + self.adjustment))
+
+class WithdrawalPolicy(object):
+    def __init__(self, rules=()):
+        self.rules = list(rules)
+        self.fallback = Inflation()
+
+    def adjust(self, portfolio, state):
+        # Returns (the new period withdrawal, the rule that determined it)
+        for rule in self.rules:
+            if rule.applies(portfolio, state):
+                break
+        else:
+            rule = self.fallback
+        return round(rule.amount(portfolio, state), 2), rule
+
+    def adjust_batch(self, portfolio, state):
+        # Returns an array of new period withdrawals.  Going through the
+        # rules backwards, each one replaces the amount where it applies,
+        # so the first rule that applies wins; rounding is elementwise, so
+        # only the chosen amounts need to be rounded.
+        amount = self.fallback.amount_batch(portfolio, state)
+        for rule in reversed(self.rules):
+            amount = np.where(rule.applies_batch(portfolio, state), rule.amount_batch(portfolio, state), amount)
+        return round_cents(amount)
+
+    def count_batch(self, portfolio, state, lanes, instrumentation):
+        # Count the rule adjust_batch chooses for each of the @lanes (a mask)
+        remaining = lanes.copy()
+        for rule in self.rules:
+            applies = remaining & rule.applies_batch(portfolio, state)
+            instrumentation.count('adjust.' + type(rule).__name__, int(np.count_nonzero(applies)))
+            remaining &= ~applies
+        instrumentation.count('adjust.' + type(self.fallback).__name__, int(np.count_nonzero(remaining)))
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.rules!r})'
+
+#
+# A withdrawal schedule varies withdrawals over the course of a period, for
+# example a "retirement smile" where withdrawals are higher at the start
+# and end of retirement and lower in the middle.
+#
+# The multiplier moves from @start (at the first withdrawal) to @middle
+# (halfway through the period) to @end (at the last withdrawal).  @shape
+# controls how it moves between those points:
+#   'linear'    a straight line
+#   'cosine'    half a cosine wave: changes slowly near the start, middle
+#               and end, and fastest in between
+#   'cubic'     smoothstep (3x^2 - 2x^3); similar to cosine, but flatter
+#               near the ends of each half
+#
+# Each withdrawal is the withdrawal determined by the WithdrawalPolicy
+# (which still adjusts for inflation, ratchets, etc.) times the multiplier,
+# rounded to cents.  The multipliers are computed once per number of ticks
+# and cached, so they are shared by every period and every Portfolio using
+# an equal schedule.
+#
+class WithdrawalSchedule(namedtuple('WithdrawalSchedule', 'start middle end shape')):
+    SHAPES = {
+        'linear': lambda x: x,
+        'cosine': lambda x: (1.0 - np.cos(np.pi * x)) / 2.0,
+        'cubic': lambda x: x * x * (3.0 - 2.0 * x),
+    }
+
+    def __new__(cls, start=1.0, middle=1.0, end=1.0, shape='linear'):
+        if shape not in cls.SHAPES:
+            raise ValueError(f'Unknown schedule shape {shape!r}; expected one of {sorted(cls.SHAPES)}')
+        return super().__new__(cls, start, middle, end, shape)
+
+    def multipliers(self, ticks):
+        '''
+        Return a read-only array of the multiplier for each of @ticks withdrawals.
+
+        >>> WithdrawalSchedule(1.2, 0.8, 1.0).multipliers(5).tolist()
+        [1.2, 1.0, 0.8, 0.9, 1.0]
+        '''
+        return _schedule_multipliers(self, ticks)
+
+@functools.lru_cache(maxsize=256)
+def _schedule_multipliers(schedule, ticks):
+    t = np.linspace(0.0, 1.0, ticks)
+    ease = WithdrawalSchedule.SHAPES[schedule.shape]
+    first_half = t < 0.5
+    x = np.where(first_half, t * 2.0, t * 2.0 - 1.0)
+    result = np.where(first_half,
+                      schedule.start + (schedule.middle - schedule.start) * ease(x),
+                      schedule.middle + (schedule.end - schedule.middle) * ease(x))
+    result.setflags(write=False)
+    return result
+
 class Portfolio(object):
     def __init__(self,
                  withdrawals_per_year = 4,
@@ -228,10 +1424,15 @@ class Portfolio(object):
                  raise_rate = 1.10,             # increase the withdrawal by this much
                  ratchet = False,
                  sustain_threshold = 0.95, # Ending with 95% of original balance (inflation adjusted) counts as "sustained"
+                 withdrawal_policy = None, # A WithdrawalPolicy; overrides paycut, raise_enable and ratchet
+                 withdrawal_schedule = None, # A WithdrawalSchedule, to vary withdrawals over time
+                 instrumentation = None,   # An Instrumentation, to count branches and time phases
                  verbose = False):
         self.shares = 0.0       # Number of shares of stock
         self.cash = 0.0         # Amount of cash, in dollars
         self.max_balance = 0.0  # Highest balance seen previously, used for cash cushion
+        self.annual_maximum = float('-inf')    # Highest year-end balance seen previously
+        self.previous_cpi = None    # CPI at the start of the current year
         self.withdrawals_per_year = withdrawals_per_year
         self.annual_withdrawal_rate = annual_withdrawal_rate
         self.initial_balance = initial_balance
@@ -249,9 +1450,14 @@ class Portfolio(object):
         self.raise_rate = raise_rate
         self.ratchet = ratchet
         self.sustain_threshold = sustain_threshold
+        self.withdrawal_policy = withdrawal_policy
+        self.withdrawal_schedule = withdrawal_schedule
+        self.instrumentation = instrumentation
         self.verbose = verbose
     #
-    # TODO: Implement a way for the withdrawal rate to vary over time.
+    # Varying the withdrawal rate over time: see withdrawal_schedule and
+    # WithdrawalSchedule (a multiplier applied to the withdrawal, with
+    # linear, cosine or cubic curves).  The original notes:
     #
     # For example, have the withdrawal rate be higher at the start and
     # end of retirement, and less in the middle ("retirement smile").
@@ -326,6 +1532,8 @@ class Portfolio(object):
             self.cash = 0.0
             self.shares = self.initial_balance / stock_price
         self.max_balance = 0.0  # Highest balance seen previously  TODO: Part of balance history?
+        self.annual_maximum = float('-inf')
+        self.previous_cpi = None
         if self.verbose:
             print(f"init: cash=${self.cash:,.2f}, shares={self.shares:,.2f}")
     
@@ -354,9 +1562,13 @@ class Portfolio(object):
             # Try to use the cash cushion to satisfy the withdrawal
             if self.cash >= amount:
                 self.cash -= amount
+                if self.instrumentation is not None:
+                    self.instrumentation.count('withdraw.cushion_cash')
                 if self.verbose:
                     print(f"withdraw: (using cushion) cash ${amount:,.2f}")
             else:
+                if self.instrumentation is not None:
+                    self.instrumentation.count('withdraw.cushion_cash_and_stock')
                 if self.verbose:
                     print(f"withdraw: (using cushion) cash ${self.cash:,.2f}, stock ${amount-self.cash:,.2f}")
                 self.shares -= (amount - self.cash) / stock_price
@@ -372,6 +1584,8 @@ class Portfolio(object):
             self.shares -= num_shares
             assert(self.shares >= 0)
             self.cash += cash_add
+            if self.instrumentation is not None:
+                self.instrumentation.count('withdraw.cushion_rebuild')
             if self.verbose:
                 print(f"withdraw: (rebuild cushion) selling {num_shares} shares; adding ${cash_add:,.2f} cash")
         else:
@@ -380,70 +1594,131 @@ class Portfolio(object):
             balance -= amount
             if balance > self.max_balance:
                 self.max_balance = balance
+            if self.instrumentation is not None:
+                self.instrumentation.count('withdraw.sell')
             if self.verbose:
                 print(f"withdraw: selling ${amount:,.2f} stock; balance ${balance:,.2f}; max_balance ${self.max_balance:,.2f}")
 
     
     def __repr__(self):
         return f'{self.__class__.__name__}(shares={self.shares})'
+
+    def config(self):
+        # The constructor arguments for this portfolio, including those of
+        # any subclass (except verbose and instrumentation)
+        names = {}
+        for cls in reversed(type(self).__mro__):
+            if issubclass(cls, Portfolio):
+                for name, parameter in inspect.signature(cls.__init__).parameters.items():
+                    if parameter.kind in (parameter.POSITIONAL_OR_KEYWORD, parameter.KEYWORD_ONLY):
+                        names[name] = None
+        return {name: getattr(self, name) for name in names if name not in ('self', 'verbose', 'instrumentation')}
     
-    def adjust_withdrawal(self, period_withdrawal, tick, history):
+    def update_running_state(self, tick_number, balance, cpi):
+        # Called at the end of each tick (after the withdrawal, dividend and
+        # interest) with the resulting balance, so that adjust_withdrawal
+        # doesn't need to scan the history.
+        if tick_number % self.withdrawals_per_year == 0:
+            self.previous_cpi = cpi
+        if tick_number % self.withdrawals_per_year == self.withdrawals_per_year - 1:
+            self.annual_maximum = max(self.annual_maximum, balance)
+
+    def adjust_withdrawal(self, period_withdrawal, tick, policy):
         # Called before the withdrawal has been made, so the next one can
         # be adjusted.
         #
         # NOTE: Currently called annually, starting with the 1-year anniversary.
         #
+        # @policy is self.policy(), built once per simulate_withdrawals.
+        #
 
-        previous_cpi = history[-self.withdrawals_per_year].cpi
+        previous_cpi = self.previous_cpi
         balance = self.balance(tick.close)
 
-        annual_maximum = max(h.balance for h in history[::-self.withdrawals_per_year])
+        annual_maximum = self.annual_maximum
         if self.verbose:
-            print(f"annual_maximum={annual_maximum}  {[h.balance for h in history[-self.withdrawals_per_year::-self.withdrawals_per_year]]}")
+            print(f"annual_maximum={annual_maximum}")
             print(f"annual_withdrawal={self.annual_withdrawal}, balance={balance}, balance*annual_withdrawal_rate={balance * self.annual_withdrawal_rate}")
 
-        if self.paycut and balance <= self.max_balance * self.paycut_threshold:
-            period_withdrawal = round(period_withdrawal * self.paycut_rate, 2)
-            if self.verbose:
-                print(f"adjust_withdrawal: pay cut; withdrawal={period_withdrawal}")
-        elif self.raise_enable and balance >= annual_maximum * self.raise_threshold:
-            period_withdrawal = round(period_withdrawal * self.raise_rate, 2)
-            if self.verbose:
-                print(f"adjust_withdrawal: raise; withdrawal={period_withdrawal}")
-        elif self.ratchet and self.annual_withdrawal < balance * self.annual_withdrawal_rate:
-            period_withdrawal = round(balance * self.annual_withdrawal_rate / self.withdrawals_per_year, 2)
-            if self.verbose:
-                print(f"adjust_withdrawal: ratchet up; withdrawal={period_withdrawal}")
-        else:
-            period_withdrawal = round(period_withdrawal * tick.CPI / previous_cpi, 2)
-            if self.verbose:
-                print(f"adjust_withdrawal: (inflation); withdrawal={period_withdrawal}")
+        state = WithdrawalState(period_withdrawal, balance, tick.CPI, previous_cpi,
+                                self.max_balance, annual_maximum, self.annual_withdrawal)
+        period_withdrawal, rule = policy.adjust(self, state)
+        if self.instrumentation is not None:
+            self.instrumentation.count('adjust.' + type(rule).__name__)
+        if self.verbose:
+            print(f"adjust_withdrawal: {rule.description}; withdrawal={period_withdrawal}")
         
         return period_withdrawal
 
+    def schedule_multipliers(self, ticks):
+        # The withdrawal multiplier for each tick of a period, or None
+        if self.withdrawal_schedule is None:
+            return None
+        return self.withdrawal_schedule.multipliers(ticks)
+
+    def policy(self):
+        # The WithdrawalPolicy given to the constructor, or else the one
+        # described by paycut, raise_enable and ratchet
+        if self.withdrawal_policy is not None:
+            return self.withdrawal_policy
+        rules = []
+        if self.paycut:
+            rules.append(PayCut(self.paycut_threshold, self.paycut_rate))
+        if self.raise_enable:
+            rules.append(Raise(self.raise_threshold, self.raise_rate))
+        if self.ratchet:
+            rules.append(Ratchet())
+        return WithdrawalPolicy(rules)
+
+    #
+    # @history controls how much of the portfolio's history is kept:
+    #   'full'      a PortfolioHistoryItem for every tick
+    #   'sampled'   the first tick of each year, plus the last tick
+    #   'none'      no history (returned as None)
+    # Regardless, self.period_stats is a PeriodStats with the running
+    # summary needed by summarize_period.
+    #
     def simulate_withdrawals(self,
-                             market_data_seq):          # Assumes monthly Shiller data, length of one retirement
-        market_data = tuple(market_data_seq)[::12//self.withdrawals_per_year]
+                             market_data_seq,           # Assumes monthly Shiller data, length of one retirement
+                             history='full'):
+        assert history in HISTORY_MODES
+        if not isinstance(market_data_seq, (MarketSeries, collections.abc.Sequence)):
+            market_data_seq = tuple(market_data_seq)
+        market_data = market_data_seq[::12//self.withdrawals_per_year]
         self.init(market_data[0].close)
         period_withdrawal = round(self.annual_withdrawal / self.withdrawals_per_year, 2)
-        history = []
-        for tick in market_data:
+        stats = self.period_stats = PeriodStats()
+        multipliers = self.schedule_multipliers(len(market_data))
+        if multipliers is not None:
+            multipliers = multipliers.tolist()
+        policy = self.policy()
+        keep_all = history == 'full'
+        history = None if history == 'none' else []
+        item = None
+        for tick_number, tick in enumerate(market_data):
             # Adjust withdrawal amount annually.  TODO: Could this be every period?
-            # TODO: Allow adjustment algorithm to be specified externally
             balance = self.balance(tick.close)
             if self.verbose:
                 print(f"{tick.date}: balance=${balance:,.2f} cash=${self.cash:,.2f} shares={self.shares} price=${tick.close:,.2f}")
-            if len(history) % self.withdrawals_per_year == 0 and len(history) > 0:
-                period_withdrawal = self.adjust_withdrawal(period_withdrawal, tick, history)
+            if tick_number % self.withdrawals_per_year == 0 and tick_number > 0:
+                period_withdrawal = self.adjust_withdrawal(period_withdrawal, tick, policy)
                 self.annual_withdrawal = period_withdrawal * self.withdrawals_per_year
                 # TODO: Should period_withdrawal be a member variable?
             
+            # The amount actually withdrawn this tick
+            if multipliers is None:
+                amount = period_withdrawal
+            else:
+                amount = round(period_withdrawal * multipliers[tick_number], 2)
+
             # Make the period's withdrawal
-            if balance < period_withdrawal:
+            if balance < amount:
+                if self.instrumentation is not None:
+                    self.instrumentation.count('failed')
                 if self.verbose:
-                    print(f"simulate_withdrawals: FAILED balance={balance:,.2f}, withdrawal={period_withdrawal:,.2f}")
-                return (False, history)
-            self.withdraw(period_withdrawal, tick.close)
+                    print(f"simulate_withdrawals: FAILED balance={balance:,.2f}, withdrawal={amount:,.2f}")
+                return (False, self._finish_history(history, item))
+            self.withdraw(amount, tick.close)
 
             # Receive dividends
             self.receive_dividend(tick.dividend/self.withdrawals_per_year, tick.close)
@@ -457,77 +1732,773 @@ class Portfolio(object):
             assert balance >= 0
 
             if self.verbose:
-                print(f"{tick.date}: balance={balance}, withdrawal={period_withdrawal}, CPI={tick.CPI}")
-            history.append(PortfolioHistoryItem(tick.date, period_withdrawal, balance, tick.close, tick.CPI))
+                print(f"{tick.date}: balance={balance}, withdrawal={amount}, CPI={tick.CPI}")
+            self.update_running_state(tick_number, balance, tick.CPI)
+            stats.add(amount, balance, tick.CPI)
+            if history is not None:
+                item = PortfolioHistoryItem(tick.date, amount, balance, tick.close, tick.CPI)
+                if keep_all or tick_number % self.withdrawals_per_year == 0:
+                    history.append(item)
 
-        return (True, history)
+        return (True, self._finish_history(history, item))
+
+    @staticmethod
+    def _finish_history(history, last_item):
+        # Make sure a sampled history ends with the last tick
+        if history is not None and last_item is not None and history[-1] is not last_item:
+            history.append(last_item)
+        return history
 
     def sim_periods(self,
                     market_data,                    # Assumes monthly Shiller data
-                    period_length = 360):           # in months/samples
-        # Get rid of any trailing market data that is incomplete
-        market_data = list(market_data)
-        while market_data[-1].dividend is None or market_data[-1].CPI is None:
-            del market_data[-1]
-        
-        survived = []           # True/False whether each period was able to make all withdrawals
-        sustained = []          # True/False whether each period's ending real balance was at least as large as the initial balance
-        balance_growth = []     # Compound Annual Growth Rate for each period's real portfolio balance
-        withdrawal_growth = []  # Compound Annual Growth Rate for each period's real withdrawal
+                    period_length = 360,            # in months/samples
+                    history = 'full'):              # See simulate_withdrawals
+        instrumentation = self.instrumentation
+        with _phase(instrumentation, 'load'):
+            # Get rid of any trailing market data that is incomplete
+            market_data = trim_market_data(market_data)
+
         periods = []
-        for period in subranges(market_data, period_length):
-            success, history = self.simulate_withdrawals(period)
-            real_balances = [i.balance * history[0].cpi / i.cpi for i in history]
-            real_min = min(real_balances)
-            real_max = max(real_balances)
-            real_last = real_balances[-1]
-            real_last_fraction = real_last / history[0].balance
-            balance_growth_rate = ((real_last / self.initial_balance) ** (12/period_length)) - 1.0
-            withdrawal_growth_rate = ((history[-1].withdrawal / history[0].withdrawal * history[0].cpi / history[-1].cpi) ** (12/period_length)) - 1.0
-            last_withdrawal_rate = history[-1].withdrawal * self.withdrawals_per_year / history[-1].balance
-            sustain = real_last >= self.initial_balance * self.sustain_threshold
-
-            periods.append(Period(period[0].date, success, sustain,
-                                  real_min, real_max, real_last, real_last_fraction, 
-                                  balance_growth_rate, withdrawal_growth_rate,
-                                  last_withdrawal_rate,
-                                  history))
-
-            survived.append(success)
-            sustained.append(sustain)
-            if success:
-                balance_growth.append(balance_growth_rate)
-                withdrawal_growth.append(withdrawal_growth_rate)
+        windows = sliding_windows(market_data, period_length)
+        while True:
+            with _phase(instrumentation, 'window'):
+                period = next(windows, None)
+            if period is None:
+                break
+            with _phase(instrumentation, 'simulate'):
+                success, period_history = self.simulate_withdrawals(period, history)
+            with _phase(instrumentation, 'aggregate'):
+                periods.append(self.summarize_period(period[0].date, success, self.period_stats,
+                                                     period_history, period_length))
+
+        with _phase(instrumentation, 'aggregate'):
+            return self.summarize_periods(PeriodTable.from_periods(periods, history))
+
+    def summarize_period(self, date, success, stats, history, period_length):
+        # @stats is a PeriodStats (or anything with the same attributes)
+        real_last_fraction = stats.real_last / stats.first_balance
+        balance_growth_rate = ((stats.real_last / self.initial_balance) ** (12/period_length)) - 1.0
+        withdrawal_growth_rate = ((stats.last_withdrawal / stats.first_withdrawal * stats.first_cpi / stats.last_cpi) ** (12/period_length)) - 1.0
+        last_withdrawal_rate = stats.last_withdrawal * self.withdrawals_per_year / stats.last_balance
+        sustain = stats.real_last >= self.initial_balance * self.sustain_threshold
+
+        return Period(date, success, sustain,
+                      stats.real_min, stats.real_max, stats.real_last, real_last_fraction,
+                      balance_growth_rate, withdrawal_growth_rate,
+                      last_withdrawal_rate,
+                      history)
+
+    def summarize_columns(self, stats, survived, period_length):
+        # Like summarize_period, for a PeriodEndpoints of arrays; returns
+        # the PeriodTable columns.  Where summarize_period would divide by
+        # zero (such as with no withdrawals), the result is NaN or infinite.
+        def power(x, y):
+            # Python's ** rather than np.power, which can differ in the last bit
+            return np.array([value ** y for value in x.tolist()])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            real_last_fraction = stats.real_last / stats.first_balance
+            balance_growth_rate = power(stats.real_last / self.initial_balance, 12/period_length) - 1.0
+            withdrawal_growth_rate = power(stats.last_withdrawal / stats.first_withdrawal * stats.first_cpi / stats.last_cpi, 12/period_length) - 1.0
+            last_withdrawal_rate = stats.last_withdrawal * self.withdrawals_per_year / stats.last_balance
+        sustain = stats.real_last >= self.initial_balance * self.sustain_threshold
+
+        return dict(zip(PeriodTable.COLUMNS, (
+            survived, sustain,
+            stats.real_min, stats.real_max, stats.real_last, real_last_fraction,
+            balance_growth_rate, withdrawal_growth_rate,
+            last_withdrawal_rate)))
 
+    def summarize_periods(self, periods):
+        # @periods is a PeriodTable or a list of Periods.  All of the
+        # periods are in memory, so the PeriodsSummary's sketch is made big
+        # enough to hold them, and its quantiles are exact.
+        #
         # Some statistics I'd like:
         #   * Survivability rate (what percentage of periods lasted long enough?)
         #   * Sustainability rate (what percentage of periods ended with at least the original amount, inflation adjusted?)
         #   * Mean/median ending withdrawal amount (real dollars).  Should it be a compound annual growth rate?
         #     If a growth rate, use harmonic mean instead of ordinary mean.
         #   Should the mean/stdev/median statistics apply only to periods that succeeded?
-        survival_rate = sum(survived) / len(survived)
-        sustain_rate = sum(sustained) / len(sustained)
-        balance_mean = statistics.mean(balance_growth)
-        balance_stdev = statistics.stdev(balance_growth, xbar=balance_mean)
-        balance_median = statistics.median(balance_growth)
-        withdraw_mean = statistics.mean(withdrawal_growth)
-        withdraw_stdev = statistics.stdev(withdrawal_growth, xbar=withdraw_mean)
-        withdraw_median = statistics.median(withdrawal_growth)
-
-        return PeriodsResult(survival_rate, sustain_rate,
-            balance_median, balance_mean, balance_stdev,
-            withdraw_median, withdraw_mean, withdraw_stdev,
-            periods)
-            
+        if not isinstance(periods, PeriodTable):
+            periods = PeriodTable.from_periods(periods)
+        summary = PeriodsSummary(capacity=max(len(periods), 1))
+        summary.add(periods.columns)
+        periods.summary = summary
+        return summary.result(periods)
+
+    #
+    # Batched equivalent of sim_periods.  Instead of simulating one period
+    # at a time, the state of the portfolio (shares, cash, max_balance,
+    # period withdrawal, ...) is kept in arrays with one "lane" per start
+    # date, and all of the periods are advanced together, one tick at a time.
+    #
+    # Lane i at tick k uses the market data at index i + k*stride, so the
+    # market data for a tick is just a slice of the column arrays.  Lanes
+    # that run out of money keep computing (harmlessly); we just remember
+    # how many ticks of their history are valid.
+    #
+    # The arithmetic mirrors simulate_withdrawals, withdraw and
+    # adjust_withdrawal operation-for-operation so that the results are
+    # identical to sim_periods.  Verbose output is not supported.
+    #
+    def sim_periods_batch(self,
+                          market_data,              # Assumes monthly Shiller data
+                          period_length = 360,      # in months/samples
+                          history = 'full'):        # See simulate_withdrawals
+        '''
+        >>> series = synthetic_series(240)
+        >>> policies = [{}, {'cash_cushion': True}, {'paycut': True}, {'raise_enable': True}, {'ratchet': True},
+        ...             {'cash_cushion': True, 'paycut': True, 'raise_enable': True, 'ratchet': True},
+        ...             {'withdrawal_policy': WithdrawalPolicy([Guardrails()])},
+        ...             {'withdrawal_schedule': WithdrawalSchedule(1.2, 0.8, 1.0, 'cosine')}]
+        >>> mismatches = []
+        >>> for args in policies:
+        ...     for withdrawals_per_year in (1, 4, 12):
+        ...         portfolio = Portfolio(withdrawals_per_year, 0.12, **args)
+        ...         for history in HISTORY_MODES:
+        ...             if portfolio.sim_periods(series, 120, history) != portfolio.sim_periods_batch(series, 120, history):
+        ...                 mismatches.append((args, withdrawals_per_year, history))
+        >>> mismatches
+        []
+        >>> 0 < Portfolio(annual_withdrawal_rate=0.12).sim_periods_batch(series, 120).survivability < 1
+        True
+        '''
+        assert history in HISTORY_MODES
+        with _phase(self.instrumentation, 'load'):
+            series = market_series(market_data)
+        lengths, balances, withdrawals = self.simulate_batch(series, period_length)
+        return self._batch_result(series, period_length, lengths, balances, withdrawals, history)
+
+    #
+    # Simulate several period lengths (horizons, in months) at once.  Each
+    # start date is simulated only once, out to the longest horizon; since
+    # a period's first N ticks don't depend on its length, the results for
+    # each shorter horizon are taken from a prefix of the same simulation.
+    # Returns a dict mapping each horizon to the PeriodsResult that
+    # sim_periods(market_data, horizon, history) would return.
+    #
+    # A withdrawal schedule is stretched to fit the period length, so with
+    # a schedule each horizon has to be simulated separately.
+    #
+    def sim_horizons(self, market_data, horizons, history='none'):
+        '''
+        >>> series = synthetic_series(240)
+        >>> portfolio = Portfolio(annual_withdrawal_rate=0.10, cash_cushion=True, ratchet=True)
+        >>> results = portfolio.sim_horizons(series, [60, 120, 180], history='full')
+        >>> [results[horizon] == portfolio.sim_periods_batch(series, horizon, 'full') for horizon in results]
+        [True, True, True]
+        '''
+        assert history in HISTORY_MODES
+        with _phase(self.instrumentation, 'load'):
+            series = market_series(market_data)
+        if self.withdrawal_schedule is not None:
+            return {horizon: self.sim_periods_batch(series, horizon, history) for horizon in horizons}
+        stride = 12 // self.withdrawals_per_year
+        lanes = len(series) - min(horizons) + 1
+        lengths, balances, withdrawals = self.simulate_batch(series, max(horizons), lanes=lanes)
+        results = {}
+        for horizon in horizons:
+            horizon_lanes = len(series) - horizon + 1
+            ticks = len(range(0, horizon, stride))
+            results[horizon] = self._batch_result(series, horizon,
+                                                  np.minimum(lengths[:horizon_lanes], ticks),
+                                                  balances[:horizon_lanes, :ticks],
+                                                  withdrawals[:horizon_lanes, :ticks], history)
+        return results
+
+    #
+    # Simulate several annual withdrawal rates at once.  The lanes are
+    # every (rate, start date) pair, with the rate as an array holding each
+    # lane's rate, so all of the rates are one batched run.  Returns a dict
+    # mapping each rate to the PeriodsResult that a Portfolio with that
+    # rate (and otherwise the same settings) would return from
+    # sim_periods(market_data, period_length, history).
+    #
+    def sim_rates(self, market_data, rates, period_length=360, history='none'):
+        '''
+        >>> series = synthetic_series(240)
+        >>> results = Portfolio(paycut=True).sim_rates(series, [0.08, 0.12, 0.16], 120, 'full')
+        >>> [results[rate] == Portfolio(annual_withdrawal_rate=rate, paycut=True).sim_periods_batch(series, 120, 'full')
+        ...  for rate in results]
+        [True, True, True]
+        '''
+        assert history in HISTORY_MODES
+        with _phase(self.instrumentation, 'load'):
+            series = market_series(market_data)
+        rates = list(rates)
+        lanes = len(series) - period_length + 1
+        lane_rates = copy.copy(self)
+        lane_rates.annual_withdrawal_rate = np.repeat(np.array(rates, dtype=np.float64), lanes)
+        with _phase(self.instrumentation, 'window'):
+            columns = [np.tile(column, (1, len(rates)))
+                       for column in self.tick_views(series, period_length, lanes)]
+        with _phase(self.instrumentation, 'simulate'):
+            lengths, balances, withdrawals = lane_rates.simulate_paths(*columns)
+        results = {}
+        for i, rate in enumerate(rates):
+            portfolio = copy.copy(self)
+            portfolio.annual_withdrawal_rate = rate
+            part = slice(i * lanes, (i+1) * lanes)
+            results[rate] = portfolio._batch_result(series, period_length, lengths[part],
+                                                    balances[part], withdrawals[part], history)
+        return results
+
+    def _batch_result(self, series, period_length, lengths, balances, withdrawals, history):
+        with _phase(self.instrumentation, 'aggregate'):
+            return self._build_batch_result(series, period_length, lengths, balances, withdrawals, history)
+
+    def _build_batch_result(self, series, period_length, lengths, balances, withdrawals, history):
+        # Build the PeriodsResult, with the same values sim_periods would give
+        lanes, ticks = balances.shape
+        stride = 12 // self.withdrawals_per_year
+        windows = sliding_window_view(np.arange(len(series)), period_length)[:lanes, ::stride]
+        cpis = sliding_window_view(series.CPI, period_length)[:lanes, ::stride]     # The CPI at windows, as a view
+        stats = batch_endpoint_columns(lengths, balances, withdrawals, cpis)
+        columns = self.summarize_columns(stats, lengths == ticks, period_length)
+        if history == 'none':
+            periods = PeriodTable(np.arange(lanes), columns, series)
+        else:
+            periods = PeriodTable(np.arange(lanes), columns, series, history, windows,
+                                  balances, withdrawals, lengths, sample=self.withdrawals_per_year)
+        return self.summarize_periods(periods)
+
+    #
+    # Like sim_periods_batch, but for synthetic market histories from a
+    # BlockBootstrap instead of the historical periods.  The paths are
+    # generated and simulated @chunk_size at a time to bound memory use;
+    # only their PeriodTable columns are kept, and the statistics are
+    # computed from those, so they don't depend on @chunk_size.  Period.date
+    # is the path number, and Period.history is None.
+    #
+    def sim_bootstrap(self, bootstrap, num_paths=10000, period_length=360, chunk_size=10000):
+        chunks = []
+        for first in range(0, num_paths, chunk_size):
+            paths = self.bootstrap_paths(bootstrap, min(chunk_size, num_paths - first), period_length)
+            lengths, balances, withdrawals = self.simulate_paths(*paths)
+            stats = batch_endpoint_columns(lengths, balances, withdrawals, paths.CPI.T)
+            chunks.append(self.summarize_columns(stats, lengths == balances.shape[1], period_length))
+        columns = {field: np.concatenate([chunk[field] for chunk in chunks])
+                   for field in PeriodTable.COLUMNS}
+        return self.summarize_periods(PeriodTable(np.arange(num_paths), columns))
+
+    def bootstrap_paths(self, bootstrap, num_paths, period_length):
+        # The arguments for simulate_paths, for @num_paths paths from @bootstrap
+        return bootstrap.paths(num_paths, period_length, 12 // self.withdrawals_per_year)
+
+    def simulate_batch(self, series, period_length=360, max_failures=None, lanes=None):
+        # Simulate every period of @period_length months in @series; see
+        # simulate_paths.  Lane i is the period starting at series[i].
+        #
+        # If @lanes is more than the number of complete periods, the later
+        # lanes run past the end of the data; the last values are repeated,
+        # and the ticks past the end are meaningless.
+        with _phase(self.instrumentation, 'window'):
+            columns = self.tick_views(series, period_length, lanes)
+        with _phase(self.instrumentation, 'simulate'):
+            return self.simulate_paths(*columns, max_failures)
+
+    def tick_views(self, series, period_length, lanes=None):
+        # The arguments for simulate_paths: tick views of the close,
+        # dividend, CPI and interest columns of @series
+        return [self.tick_view(column, period_length, lanes) for column in
+                (series.close, series.dividend, series.CPI, series.interest)]
+
+    def tick_view(self, column, period_length, lanes=None):
+        # A (ticks x lanes) view of @column whose row k is tick k of every period
+        stride = 12 // self.withdrawals_per_year
+        if lanes is None:
+            lanes = len(column) - period_length + 1
+        ticks = len(range(0, period_length, stride))
+        needed = lanes + (ticks-1)*stride
+        if needed > len(column):
+            column = np.pad(column, (0, needed - len(column)), mode='edge')
+        return sliding_window_view(column, lanes)[:(ticks-1)*stride+1:stride]
+
+    def simulate_paths(self, close, dividend, cpi, interest, max_failures=None):
+        # The market data arguments are (ticks x lanes) arrays, already at
+        # the withdrawal frequency: row k holds tick k of every lane.
+        #
+        # Returns (lengths, balances, withdrawals): the number of valid ticks
+        # of history for each lane, and (lanes x ticks) arrays of the balance
+        # and withdrawal at each tick.  A lane survived if its length is the
+        # full number of ticks.
+        #
+        # If more than @max_failures lanes fail, gives up early and returns None.
+        return self.simulate_lanes(cpi, functools.partial(self.stock_lanes, close, dividend, interest),
+                                   max_failures)
+
+    def simulate_lanes(self, cpi, start_lanes, max_failures=None):
+        # The part of simulate_paths that doesn't depend on what the
+        # portfolio holds: the withdrawal policy and schedule, and noticing
+        # failures.  @cpi is the (ticks x lanes) CPI.
+        #
+        # start_lanes(annual_withdrawal) sets up the holdings of each lane,
+        # and returns (balance, step): the balance of each lane at tick 0,
+        # and a function step(k, balance, amount, max_balance,
+        # annual_withdrawal, alive) that withdraws @amount at tick k, then does whatever else happens that
+        # tick (receiving dividends, rebalancing, ...).  It returns
+        # (balance after tick k, new max_balance, balance at tick k+1 before
+        # withdrawing, or None after the last tick).
+        wpy = self.withdrawals_per_year
+        ticks, lanes = cpi.shape
+        policy = self.policy()
+        instrumentation = self.instrumentation
+        multipliers = self.schedule_multipliers(ticks)
+
+        # Filled a tick (row) at a time; returned transposed, as (lanes x ticks)
+        balances = np.empty((ticks, lanes))
+        withdrawals = np.empty((ticks, lanes))
+        lengths = np.full(lanes, ticks)
+        alive = np.ones(lanes, dtype=bool)
+
+        # Equivalent of init()
+        annual_withdrawal = np.full(lanes, self.initial_balance * self.annual_withdrawal_rate)
+        balance, step = start_lanes(annual_withdrawal)
+        max_balance = np.zeros(lanes)
+        annual_maximum = np.full(lanes, -np.inf)    # Maximum of the year-end balances
+        period_withdrawal = round_cents(annual_withdrawal / wpy)
+
+        for k in range(ticks):
+            if k % wpy == 0 and k > 0:
+                state = WithdrawalState(period_withdrawal, balance, cpi[k], cpi[k - wpy],
+                                        max_balance, annual_maximum, annual_withdrawal)
+                if instrumentation is not None:
+                    policy.count_batch(self, state, alive, instrumentation)
+                period_withdrawal = policy.adjust_batch(self, state)
+                annual_withdrawal = period_withdrawal * wpy
+
+            # The amount actually withdrawn this tick
+            if multipliers is None:
+                amount = period_withdrawal
+            else:
+                amount = round_cents(period_withdrawal * multipliers[k])
+
+            failed = alive & (balance < amount)
+            if failed.any():
+                lengths[failed] = k
+                alive &= ~failed
+                if instrumentation is not None:
+                    instrumentation.count('failed', int(np.count_nonzero(failed)))
+                if max_failures is not None and lanes - alive.sum() > max_failures:
+                    return None
+
+            end_balance, max_balance, balance = step(k, balance, amount, max_balance, annual_withdrawal, alive)
+            balances[k] = end_balance
+            withdrawals[k] = amount
+            if k % wpy == wpy - 1:
+                annual_maximum = np.maximum(annual_maximum, end_balance)
+
+        # Ticks after a lane failed are meaningless
+        balances, withdrawals = balances.T, withdrawals.T
+        if not alive.all():
+            after = np.arange(ticks) >= lengths[:, np.newaxis]
+            balances[after] = np.nan
+            withdrawals[after] = np.nan
+
+        return lengths, balances, withdrawals
+
+    def stock_lanes(self, close, dividend, interest, annual_withdrawal):
+        # The start_lanes of simulate_paths (see simulate_lanes): each lane
+        # holds shares of stock, and cash
+        wpy = self.withdrawals_per_year
+        ticks, lanes = close.shape
+        instrumentation = self.instrumentation
+        if self.cash_cushion:
+            cash = self.cash_cushion_target * annual_withdrawal
+        else:
+            cash = np.zeros(lanes)
+        shares = (self.initial_balance - cash) / close[0]
+
+        def step(k, balance, amount, max_balance, annual_withdrawal, alive):
+            nonlocal cash, shares
+            price = close[k]
+
+            # Equivalent of withdraw()
+            if self.cash_cushion:
+                cash_target = annual_withdrawal * self.cash_cushion_target
+                remaining = balance - amount
+                use_cash = balance < max_balance * self.cash_use_threshold
+                rebuild = (~use_cash &
+                           (remaining >= max_balance * self.cash_rebuild_threshold) &
+                           (cash < cash_target))
+                sell = ~(use_cash | rebuild)
+                if instrumentation is not None:
+                    cash_only = use_cash & (cash >= amount)
+                    for name, mask in (('cushion_cash', cash_only), ('cushion_cash_and_stock', use_cash ^ cash_only),
+                                       ('cushion_rebuild', rebuild), ('sell', sell)):
+                        instrumentation.count('withdraw.' + name, int(np.count_nonzero(mask & alive)))
+                cash_add = np.minimum(np.minimum(cash_target - cash,
+                                                 amount * (self.cash_rebuild_rate - 1.0)),
+                                      balance - max_balance)
+
+                # The change in cash: using the cash cushion spends as much
+                # of @amount as it can (the rest is sold from stock), and
+                # rebuilding adds cash_add.  Adding it to cash, and
+                # amount + change to the stock sold, does the same
+                # arithmetic as each of withdraw()'s cases, to the bit: for
+                # instance, selling amount + -cash is amount - cash, and
+                # selling amount + -amount sells nothing.
+                change = np.where(use_cash, -np.minimum(cash, amount), np.where(rebuild, cash_add, 0.0))
+                shares = shares - (amount + change) / price
+                cash = cash + change
+                max_balance = np.where(sell, np.maximum(max_balance, remaining), max_balance)
+            else:
+                shares = shares - amount / price
+                max_balance = np.maximum(max_balance, balance - amount)
+                if instrumentation is not None:
+                    instrumentation.count('withdraw.sell', int(np.count_nonzero(alive)))
+
+            # Receive dividends and interest
+            shares = shares + shares * (dividend[k] / wpy) / price
+            cash = cash + cash * (interest[k] / wpy)
+
+            # The balances after this tick and before the next one (at the
+            # prices close[k:k+2]), rounded together
+            if k+1 < ticks:
+                end_balance, next_balance = round_cents(cash + shares * close[k:k+2])
+                return end_balance, max_balance, next_balance
+            return round_cents(cash + shares * price), max_balance, None
+
+        return round_cents(cash + shares * close[0]), step
+
+#
+# A persistent, size-bounded cache of sim_periods results.
+#
+#   cache = ResultCache()
+#   result = cache.sim_periods(Portfolio(cash_cushion=True, ratchet=True), market_data, 480)
+#
+# Results are keyed on the Portfolio's configuration, the period length,
+# the history mode and a fingerprint of the market data itself, so a
+# change to the CSV files automatically misses the cache.  Each result is
+# a pickle file in @directory; when the files total more than @max_bytes,
+# the least recently used ones are removed.
+#
+# The key also includes RESULT_CACHE_VERSION, which must be increased
+# whenever a change to the simulation engines or to the result classes
+# could change (or fail to unpickle) a cached result.  Any entry that
+# can't be loaded is treated as a miss.
+#
+RESULT_CACHE_VERSION = 1
+
+class ResultCache(object):
+    def __init__(self, directory='__resultcache__', max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def key(self, portfolio, series, period_length, history):
+        config = sorted(portfolio.config().items())
+        text = repr((RESULT_CACHE_VERSION, type(portfolio).__name__, config, period_length, history,
+                     fingerprint(series)))
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def sim_periods(self, portfolio, market_data, period_length=360, history='none'):
+        series = market_series(market_data)
+        path = os.path.join(self.directory, self.key(portfolio, series, period_length, history) + '.pickle')
+        try:
+            with open(path, 'rb') as f:
+                result = pickle.load(f)
+            os.utime(path)      # Mark it as recently used
+            return result
+        except Exception:
+            pass        # Missing, or written by an older version of the code
+
+        result = portfolio.sim_periods_batch(series, period_length, history)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path + '.tmp', 'wb') as f:
+                pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(path + '.tmp', path)
+            self.evict()
+        except OSError:
+            pass        # Not being able to write the cache is harmless
+        return result
+
+    def evict(self):
+        # Remove least recently used results until they fit in max_bytes
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.pickle'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def clear(self):
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.pickle'):
+                os.remove(entry.path)
+
+def fingerprint(series):
+    # A hash of the contents of a MarketSeries
+    digest = hashlib.sha256(series.unit.encode())
+    digest.update(np.ascontiguousarray(series.index).tobytes())
+    for name, values in series.columns.items():
+        digest.update(name.encode())
+        digest.update(np.ascontiguousarray(values).tobytes())
+    return digest.hexdigest()
+
+#
+# Multi-asset portfolios.
+#
+# The asset classes are stocks (the S&P 500, with dividends reinvested),
+# bonds (a constant maturity Treasury fund, whose returns are derived from
+# Shiller's GS10 yields) and cash (earning the T-bill interest column).
+#
+ASSET_CLASSES = ('stocks', 'bonds', 'cash')
+
+def bond_returns(yields, maturity=10):
+    '''
+    Monthly total returns of a constant maturity bond fund, from monthly
+    yields in percent (such as GS10).  Each month the fund buys a new
+    @maturity year bond at par, paying monthly coupons at that month's
+    yield, and sells it a month later at the next month's yield.  Element
+    i is the return from month i to month i+1.
+
+    >>> [round(r, 6) for r in bond_returns(np.array([6.0, 6.0, 5.0, 7.0])).tolist()]
+    [0.005, 0.083062, -0.138548]
+    '''
+    coupon = yields[:-1] / 1200.0           # Monthly coupon rate of the bond bought
+    rate = yields[1:] / 1200.0              # Monthly yield when it is sold
+    discount = (1.0 + rate) ** -(maturity * 12 - 1)
+    price = coupon / rate * (1.0 - discount) + discount
+    return price - 1.0 + coupon
+
+def bond_index(series, maturity=10):
+    '''
+    The monthly total return index of the bond fund of bond_returns, for a
+    MarketSeries with a GS10 column: its value over time, per dollar at
+    the start of @series.  Missing GS10 yields are taken to be the same as
+    the previous month's.
+    '''
+    yields = series.GS10
+    valid = np.where(np.isnan(yields), 0, np.arange(len(yields)))
+    returns = bond_returns(yields[np.maximum.accumulate(valid)], maturity)
+    return np.concatenate([[1.0], np.cumprod(1.0 + returns)])
+
+#
+# A Portfolio holding several asset classes in target proportions, for
+# example 90/10, 80/20 or 50/50 stocks and bonds:
+#
+#   AllocationPortfolio({'stocks': 0.8, 'bonds': 0.2}).sim_periods_batch(load_market_data())
+#
+# The holdings are an (assets x lanes) array of units: shares of stock,
+# units of the bond fund's total return index (see bond_index), and
+# dollars of cash.  Every start date is simulated at once, like
+# sim_periods_batch.  Each tick, the withdrawal is taken from all of the
+# assets in proportion to their value, any lane in which some asset's
+# weight is more than @rebalance_band away from its target is rebalanced
+# to the targets, and then dividends are reinvested and interest earned;
+# each of those steps is one array operation across all of the lanes.
+#
+# Stocks and cash follow the same conventions as Portfolio: at each tick,
+# the stock earns that month's dividend divided by withdrawals_per_year,
+# and the cash that month's interest rate divided by withdrawals_per_year.
+# So with 100% stocks, the results are exactly those of a Portfolio.
+#
+# The withdrawal policy and schedule work as for Portfolio; the cash
+# cushion does not apply.  The market data (including that given to a
+# BlockBootstrap for sim_bootstrap) must have a GS10 column to hold bonds,
+# and an interest column to hold cash; load_market_data has both.  Only the
+# batched engine is implemented: sim_periods is the same as
+# sim_periods_batch, and simulate_withdrawals runs a batch of one lane.
+#
+class AllocationPortfolio(Portfolio):
+    def __init__(self,
+                 weights = None,            # Asset class -> target weight; default 60% stocks, 40% bonds
+                 rebalance_band = 0.05,     # Rebalance when a weight is this far from its target
+                 bond_maturity = 10,        # Years
+                 **portfolio_args):         # See Portfolio
+        super().__init__(**portfolio_args)
+        if weights is None:
+            weights = {'stocks': 0.6, 'bonds': 0.4}
+        if self.cash_cushion:
+            raise ValueError('AllocationPortfolio does not support a cash cushion')
+        if not set(weights) <= set(ASSET_CLASSES):
+            raise ValueError(f'unknown asset classes: {sorted(set(weights) - set(ASSET_CLASSES))}')
+        if abs(sum(weights.values()) - 1.0) > 1e-9:
+            raise ValueError(f'weights must add up to 1: {weights}')
+        self.weights = {asset: weights[asset] for asset in ASSET_CLASSES if asset in weights}
+        self.rebalance_band = rebalance_band
+        self.bond_maturity = bond_maturity
+
+    def sim_periods(self, market_data, period_length=360, history='full'):
+        return self.sim_periods_batch(market_data, period_length, history)
+
+    def simulate_withdrawals(self, market_data_seq, history='full'):
+        '''
+        Like Portfolio.simulate_withdrawals, for one period, simulated as a
+        batch of one lane.
+
+        >>> series = synthetic_series(240)
+        >>> portfolio = AllocationPortfolio({'stocks': 0.6, 'bonds': 0.3, 'cash': 0.1}, annual_withdrawal_rate=0.08)
+        >>> success, history = portfolio.simulate_withdrawals(series[:120])
+        >>> period = portfolio.sim_periods_batch(series, 120).periods[0]
+        >>> (success, history) == (period.survived, period.history)
+        True
+        '''
+        assert history in HISTORY_MODES
+        if not isinstance(market_data_seq, MarketSeries):
+            market_data_seq = MarketSeries.from_records(market_data_seq)
+        series = market_data_seq
+        stride = 12 // self.withdrawals_per_year
+        windows = np.arange(len(series))[np.newaxis, ::stride]
+        lengths, balances, withdrawals = self.simulate_batch(series, len(series))
+        length = int(lengths[0])
+        self.period_stats = PeriodStats()
+        if length:
+            for name, value in batch_endpoints(lengths, balances, withdrawals, series.CPI[windows])[0]._asdict().items():
+                setattr(self.period_stats, name, value)
+        if history == 'none':
+            items = None
+        elif length == 0:
+            items = []
+        else:
+            items = PeriodTable(np.arange(1), {}, series, history, windows, balances, withdrawals, lengths,
+                                sample=self.withdrawals_per_year).period_history(0)
+        if self.verbose and items:
+            print_history(items)
+        return (length == windows.shape[1], items)
+
+    def bootstrap_paths(self, bootstrap, num_paths, period_length):
+        # The arguments for simulate_paths: the bootstrap's paths, plus the
+        # bonds' total return over the same historical months
+        self.check_columns(bootstrap.series)
+        bonds = self.bonds(bootstrap.series)
+        return bootstrap.allocation_paths(bonds, num_paths, period_length, 12 // self.withdrawals_per_year)
+
+    def tick_views(self, series, period_length, lanes=None):
+        # The arguments for simulate_paths: tick views of the close,
+        # dividend, CPI and interest columns (as for Portfolio), and of the
+        # bonds' total return index
+        self.check_columns(series)
+        interest = series.interest if 'cash' in self.weights else np.zeros(len(series))
+        return [self.tick_view(column, period_length, lanes) for column in
+                (series.close, series.dividend, series.CPI, interest, self.bonds(series))]
+
+    def check_columns(self, series):
+        needed = {'bonds': 'GS10', 'cash': 'interest'}
+        for asset in self.weights:
+            if asset in needed and needed[asset] not in series.columns:
+                raise ValueError(f'holding {asset} needs the {needed[asset]} column of the market data '
+                                 f'(which has {", ".join(series.columns)})')
+
+    def bonds(self, series):
+        # The bonds' monthly total return index, or ones if there are no bonds
+        if 'bonds' in self.weights:
+            return bond_index(series, self.bond_maturity)
+        return np.ones(len(series))
+
+    def simulate_paths(self, close, dividend, cpi, interest, bonds, max_failures=None):
+        '''
+        Like Portfolio.simulate_paths, with the addition of the
+        (ticks x lanes) total return index of the @bonds.
+
+        >>> series = synthetic_series(240)
+        >>> [Portfolio(withdrawals_per_year, 0.12, ratchet=True).sim_periods_batch(series, 120) ==
+        ...  AllocationPortfolio({'stocks': 1.0}, withdrawals_per_year=withdrawals_per_year,
+        ...                      annual_withdrawal_rate=0.12, ratchet=True).sim_periods_batch(series, 120)
+        ...  for withdrawals_per_year in (1, 4, 12)]
+        [True, True, True]
+        '''
+        return self.simulate_lanes(cpi, functools.partial(self.allocation_lanes, close, dividend, interest, bonds),
+                                   max_failures)
+
+    def allocation_lanes(self, close, dividend, interest, bonds, annual_withdrawal):
+        # The start_lanes of simulate_paths (see simulate_lanes): each lane
+        # holds units of each asset
+        wpy = self.withdrawals_per_year
+        ticks, lanes = close.shape
+        instrumentation = self.instrumentation
+        assets = list(self.weights)
+        target = np.array(list(self.weights.values()))[:, np.newaxis]
+        stocks = assets.index('stocks') if 'stocks' in assets else None
+        cash = assets.index('cash') if 'cash' in assets else None
+        one = np.ones(lanes)
+        unit_prices = [{'stocks': close, 'bonds': bonds, 'cash': None}[asset] for asset in assets]
+
+        def prices(k):
+            # The (assets x lanes) price of a unit of each asset at tick k
+            return np.stack([one if column is None else column[k] for column in unit_prices])
+
+        units = target * self.initial_balance / prices(0)
+
+        def step(k, balance, amount, max_balance, annual_withdrawal, alive):
+            nonlocal units
+            price = prices(k)
+
+            # Withdraw from every asset in proportion to its value, then
+            # rebalance (lanes that have failed may divide by zero; they're
+            # ignored)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                values = units * price
+                units = units - amount * (values / values.sum(axis=0)) / price
+                values = units * price
+                total = values.sum(axis=0)
+                drifted = (np.abs(values / total - target) > self.rebalance_band).any(axis=0)
+                units = np.where(drifted, target * total / price, units)
+            if instrumentation is not None:
+                instrumentation.count('rebalance', int(np.count_nonzero(drifted & alive)))
+            max_balance = np.maximum(max_balance, balance - amount)
+
+            # Receive dividends and interest
+            if stocks is not None:
+                units[stocks] = units[stocks] + units[stocks] * (dividend[k] / wpy) / close[k]
+            if cash is not None:
+                units[cash] = units[cash] + units[cash] * (interest[k] / wpy)
+
+            next_balance = round_cents((units * prices(k+1)).sum(axis=0)) if k+1 < ticks else None
+            return round_cents((units * price).sum(axis=0)), max_balance, next_balance
+
+        return round_cents((units * prices(0)).sum(axis=0)), step
+
+#
+# Find the highest annual withdrawal rate for which at least @target of the
+# periods survive (i.e., have survivability >= target), to within @tolerance.
+# The remaining keyword arguments are passed to @portfolio_class.
+#
+# The rate is first bracketed (doubling @high until it fails), then found by
+# bisection.  Each trial stops as soon as too many periods have failed to
+# reach the target.
+#
+# @portfolio_class can be any Portfolio subclass with a batched engine,
+# such as AllocationPortfolio.
+#
+def max_withdrawal_rate(market_data, target=1.0, period_length=360,
+                        low=0.0, high=0.10, tolerance=0.0001, portfolio_class=Portfolio, **portfolio_args):
+    series = market_series(market_data)
+    lanes = len(series) - period_length + 1
+    max_failures = int(lanes * (1.0 - target) + 1e-9)
+
+    def survives(rate):
+        portfolio = portfolio_class(annual_withdrawal_rate=rate, **portfolio_args)
+        return portfolio.simulate_batch(series, period_length, max_failures) is not None
+
+    if low > 0.0 and not survives(low):
+        raise ValueError(f'No withdrawal rate >= {low} reaches survivability of {target}')
+    while survives(high):
+        low, high = high, high * 2
+        if high > 1.0:
+            raise ValueError(f'Withdrawal rate of {low} still reaches survivability of {target}')
+    while high - low > tolerance:
+        middle = (low + high) / 2
+        if survives(middle):
+            low = middle
+        else:
+            high = middle
+    return low
+
 def print_history(history):
     for item in history:
         print(f"{item.date}: withdrawal={item.withdrawal}  balance={item.balance}  stock_price={item.stock_price}  cpi={item.cpi}")
     print()
     
 def main():
-    for decline in declines(read_yahoo()):
-        if decline.percent >= 0.05:
-            print(decline.summarize())
+    for decline in stream_declines('^GSPC.csv', min_percent=0.05):
+        print(decline.summarize())
 
 if __name__ == '__main__':
     main()
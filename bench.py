@@ -0,0 +1,177 @@
+#!python3
+#
+# Benchmarks for the simulation and data loading hot paths.
+#
+#   python bench.py                         run everything, print JSON results
+#   python bench.py -o results.json         also save the results
+#   python bench.py -b baseline.json        compare against saved results;
+#                                           exits with status 1 on a regression
+#   python bench.py -k sim_periods          only run benchmarks whose name contains "sim_periods"
+#
+# Each benchmark is timed several times, after one untimed warm-up run; the
+# minimum is the number compared against the baseline, since it is the
+# least sensitive to noise from other processes.
+#
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+import numpy as np
+
+import StockMarket
+from StockMarket2 import (Portfolio, declines, stream_declines, drawdowns, subranges, sliding_windows,
+                          read_yahoo, load_market_data, load_yahoo)
+
+BENCHMARKS = {}
+
+def benchmark(name, repeat=5):
+    def register(function):
+        BENCHMARKS[name] = (function, repeat)
+        return function
+    return register
+
+_market_data = None
+def market_data():
+    # The same monthly data for every benchmark
+    global _market_data
+    if _market_data is None:
+        _market_data = list(load_market_data())
+    return _market_data
+
+@benchmark('sim_periods_360')
+def bench_sim_periods_360():
+    Portfolio().sim_periods(market_data())
+
+@benchmark('sim_periods_cushion_ratchet_360')
+def bench_sim_periods_cushion_ratchet_360():
+    Portfolio(cash_cushion=True, ratchet=True).sim_periods(market_data())
+
+@benchmark('sim_periods_480')
+def bench_sim_periods_480():
+    Portfolio().sim_periods(market_data(), period_length=480)
+
+@benchmark('sim_periods_batch_360')
+def bench_sim_periods_batch_360():
+    Portfolio().sim_periods_batch(market_data())
+
+@benchmark('sim_periods_batch_cushion_ratchet_480_no_history', repeat=20)
+def bench_sim_periods_batch_cushion_ratchet_480_no_history():
+    Portfolio(cash_cushion=True, ratchet=True).sim_periods_batch(market_data(), 480, history='none')
+
+@benchmark('subranges_360')
+def bench_subranges_360():
+    for subrange in subranges(market_data(), 360):
+        pass
+
+@benchmark('sliding_windows_360')
+def bench_sliding_windows_360():
+    for window in sliding_windows(market_data(), 360):
+        pass
+
+@benchmark('simulation_run')
+def bench_simulation_run():
+    with contextlib.redirect_stdout(io.StringIO()):
+        for simulation in (StockMarket.AllStock, StockMarket.NinetyTen, StockMarket.EightyTwenty,
+                           StockMarket.FiftyFifty, StockMarket.CashCushion):
+            simulation().run()
+
+@benchmark('simulation_run_batch', repeat=20)
+def bench_simulation_run_batch():
+    with contextlib.redirect_stdout(io.StringIO()):
+        for simulation in (StockMarket.AllStock, StockMarket.NinetyTen, StockMarket.EightyTwenty,
+                           StockMarket.FiftyFifty, StockMarket.CashCushion):
+            simulation().RunBatch()
+
+@benchmark('read_yahoo')
+def bench_read_yahoo():
+    for tick in read_yahoo():
+        pass
+
+@benchmark('load_yahoo_cached', repeat=20)
+def bench_load_yahoo_cached():
+    load_yahoo()
+
+@benchmark('declines_daily')
+def bench_declines_daily():
+    for decline in declines(read_yahoo()):
+        pass
+
+@benchmark('stream_declines_daily')
+def bench_stream_declines_daily():
+    for decline in stream_declines('^GSPC.csv'):
+        pass
+
+@benchmark('drawdowns_daily', repeat=20)
+def bench_drawdowns_daily():
+    drawdowns(load_yahoo())
+
+def run(names, repeat=None):
+    results = {}
+    for name in names:
+        function, default_repeat = BENCHMARKS[name]
+        function()          # Warm up (and load any data)
+        times = []
+        for i in range(repeat or default_repeat):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+        results[name] = {'min': min(times), 'median': statistics.median(times),
+                         'mean': statistics.mean(times), 'runs': len(times)}
+        print(f'{name:50} {min(times)*1000:10.2f} ms', file=sys.stderr)
+    return results
+
+def compare(results, baseline, threshold):
+    # Returns the names of the benchmarks that are slower than @threshold
+    # times their baseline.
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result['min'] / baseline[name]['min']
+        flag = ''
+        if ratio > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f'{name:50} {ratio:6.2f}x baseline{flag}', file=sys.stderr)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the simulation and data loading hot paths.')
+    parser.add_argument('-k', '--filter', default='', help='only run benchmarks whose name contains this')
+    parser.add_argument('-n', '--repeat', type=int, default=None, help='timed runs per benchmark')
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    parser.add_argument('-b', '--baseline', help='compare against the results in this JSON file')
+    parser.add_argument('-t', '--threshold', type=float, default=1.25,
+                        help='slowdown (vs. baseline) that counts as a regression (default: 1.25)')
+    args = parser.parse_args(argv)
+
+    # The data files are relative to this directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    names = [name for name in BENCHMARKS if args.filter in name]
+    output = {'python': platform.python_version(), 'numpy': np.__version__,
+              'machine': platform.machine(), 'tbills': os.path.exists('TB3MS.csv'),
+              'results': run(names, args.repeat)}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        print()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        if compare(output['results'], baseline, args.threshold):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,232 @@
+#!python3
+#
+# A local service that answers Portfolio.sim_periods queries over HTTP, on
+# localhost or a Unix socket, using only the standard library.
+#
+# Example:
+#   python service.py --port 8765 &             (--shiller/--tbills to pick the data files)
+#   curl 'http://127.0.0.1:8765/sim?annual_withdrawal_rate=0.035&cash_cushion=True'
+#   curl -d '[{"annual_withdrawal_rate": 0.04}, {"ratchet": true, "period_length": 480}]' http://127.0.0.1:8765/sim
+#
+#   python service.py --unix /tmp/stockmarket.sock &
+#   curl --unix-socket /tmp/stockmarket.sock 'http://localhost/sim?ratchet=True'
+#
+# A query is a set of Portfolio keyword arguments, plus an optional
+# period_length (default 360).  GET takes them as URL parameters (Python
+# literals); POST takes a JSON object, or a list of them.  The answer is
+# the summary fields of PeriodsResult plus the growth rate percentiles
+# (see PeriodsSummary), as JSON; statistics that can't be computed (such
+# as withdrawal growth with no withdrawals) are null.  GET /stats returns
+# counters.
+#
+# The market data is loaded once and kept in memory.  Queries that arrive
+# within a few milliseconds of each other are answered together: queries
+# that differ only in annual_withdrawal_rate are simulated in one batched
+# run (see Portfolio.sim_rates), and identical queries are simulated only
+# once.  Answers are kept in an LRU cache shared by all clients.
+#
+
+import argparse
+import ast
+import asyncio
+import collections
+import http
+import inspect
+import json
+import math
+import urllib.parse
+
+from StockMarket2 import (Portfolio, PeriodsResult, PeriodsSummary, WithdrawalSchedule,
+                          load_market_data, market_series)
+
+SUMMARY_FIELDS = PeriodsResult._fields[:-1] + PeriodsSummary.PERCENTILE_FIELDS
+
+# The Portfolio arguments a query may set
+QUERY_ARGS = set(inspect.signature(Portfolio).parameters) - {'withdrawal_policy', 'instrumentation', 'verbose'}
+
+class QueryError(Exception):
+    pass
+
+class SimulationService(object):
+    def __init__(self, market_data, batch_delay=0.005, cache_size=4096):
+        self.series = market_series(market_data)
+        self.batch_delay = batch_delay      # Seconds to wait for more queries to batch together
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()      # Query key -> answer, least recently used first
+        self.pending = {}                   # Query key -> (portfolio args, period length, future)
+        self.batch = None                   # The task that will run the pending queries
+        self.counters = collections.Counter()
+
+    def parse(self, query):
+        # Returns (Portfolio arguments, period length, key) for a query dict
+        args = dict(query)
+        period_length = args.pop('period_length', 360)
+        if not isinstance(period_length, int) or not 0 < period_length <= len(self.series):
+            raise QueryError(f'invalid period_length: {period_length!r} '
+                             f'(the market data has {len(self.series)} months)')
+        unknown = set(args) - QUERY_ARGS
+        if unknown:
+            raise QueryError(f'unknown arguments: {", ".join(sorted(unknown))}')
+        rate = args.get('annual_withdrawal_rate', 0.04)
+        if not isinstance(rate, (int, float)) or isinstance(rate, bool) or not 0 <= rate < 1:
+            raise QueryError(f'invalid annual_withdrawal_rate: {rate!r}')
+        wpy = args.get('withdrawals_per_year', 4)
+        if not isinstance(wpy, int) or isinstance(wpy, bool) or wpy <= 0 or 12 % wpy:
+            raise QueryError(f'invalid withdrawals_per_year: {wpy!r} (must divide 12)')
+        if args.get('withdrawal_schedule') is not None:
+            args['withdrawal_schedule'] = WithdrawalSchedule(*args['withdrawal_schedule'])
+        config = Portfolio(**args).config()
+        return args, period_length, repr((sorted(config.items()), period_length))
+
+    async def query(self, query):
+        args, period_length, key = self.parse(query)
+        self.counters['queries'] += 1
+        if key in self.cache:
+            self.counters['cache_hits'] += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        if key not in self.pending:
+            future = asyncio.get_running_loop().create_future()
+            self.pending[key] = (args, period_length, future)
+            if self.batch is None:
+                self.batch = asyncio.create_task(self.run_batch())
+        return await asyncio.shield(self.pending[key][2])
+
+    async def run_batch(self):
+        await asyncio.sleep(self.batch_delay)
+        pending, self.pending, self.batch = self.pending, {}, None
+        self.counters['batches'] += 1
+
+        # Group the queries that differ only in the withdrawal rate
+        groups = collections.defaultdict(list)
+        for key, (args, period_length, future) in pending.items():
+            common = dict(args)
+            rate = common.pop('annual_withdrawal_rate', 0.04)
+            group = repr((sorted(Portfolio(**common).config().items()), period_length))
+            groups[group].append((key, common, period_length, rate, future))
+
+        loop = asyncio.get_running_loop()
+        async def run_group(queries):
+            common, period_length = queries[0][1:3]
+            rates = [rate for key, common, period_length, rate, future in queries]
+            self.counters['runs'] += 1
+            try:
+                answers = await loop.run_in_executor(None, self.simulate, common, period_length, rates)
+            except Exception as e:
+                for key, common, period_length, rate, future in queries:
+                    future.set_exception(e)
+                return
+            for key, common, period_length, rate, future in queries:
+                self.remember(key, answers[rate])
+                future.set_result(answers[rate])
+        await asyncio.gather(*(run_group(queries) for queries in groups.values()))
+
+    def simulate(self, args, period_length, rates):
+        # Returns a dict mapping each rate to its answer.  Statistics that
+        # are NaN (see PeriodsSummary) become None, since JSON has no NaN.
+        results = Portfolio(**args).sim_rates(self.series, rates, period_length, history='none')
+        return {rate: {name: value if math.isfinite(value) else None
+                       for name, value in zip(SUMMARY_FIELDS, tuple(result[:-1]) +
+                                              tuple(result.periods.summary.percentiles().values()))}
+                for rate, result in results.items()}
+
+    def remember(self, key, answer):
+        self.cache[key] = answer
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    #
+    # HTTP
+    #
+    async def respond(self, method, target, body):
+        # Returns (status, JSON-able payload)
+        url = urllib.parse.urlsplit(target)
+        if url.path == '/stats':
+            return 200, dict(self.counters, cached=len(self.cache))
+        if url.path != '/sim':
+            return 404, {'error': f'not found: {url.path}'}
+        try:
+            if method == 'GET':
+                queries = {name: parse_value(value) for name, value in urllib.parse.parse_qsl(url.query)}
+            elif method == 'POST':
+                queries = json.loads(body)
+            else:
+                return 405, {'error': f'method not allowed: {method}'}
+            if isinstance(queries, list):
+                return 200, await asyncio.gather(*(self.query(query) for query in queries))
+            return 200, await self.query(queries)
+        except (QueryError, TypeError, ValueError) as e:
+            return 400, {'error': str(e)}
+        except Exception as e:
+            return 500, {'error': f'{type(e).__name__}: {e}'}
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, sep, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                status, payload = await self.respond(method, target, body)
+                data = json.dumps(payload, allow_nan=False).encode()
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                writer.write(f'HTTP/1.1 {status} {http.HTTPStatus(status).phrase}\r\n'
+                             f'Content-Type: application/json\r\n'
+                             f'Content-Length: {len(data)}\r\n'
+                             f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode() + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass        # A broken or malformed request; just drop the connection
+        finally:
+            writer.close()
+
+def parse_value(text):
+    # A Python literal, or else the string itself
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return text
+
+async def serve(service, host='127.0.0.1', port=8765, unix=None):
+    if unix:
+        server = await asyncio.start_unix_server(service.handle_connection, path=unix)
+    else:
+        server = await asyncio.start_server(service.handle_connection, host, port)
+    async with server:
+        await server.serve_forever()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Answer Portfolio.sim_periods queries over HTTP.')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8765, help='port to listen on (default: 8765)')
+    parser.add_argument('--unix', metavar='PATH', help='listen on this Unix socket instead')
+    parser.add_argument('--batch-delay', type=float, default=5.0,
+                        help='milliseconds to wait for queries to batch together (default: 5)')
+    parser.add_argument('--cache-size', type=int, default=4096,
+                        help='number of answers to cache (default: 4096)')
+    parser.add_argument('--shiller', default='ie_data-2.csv', metavar='FILE',
+                        help="Shiller's market data (default: ie_data-2.csv)")
+    parser.add_argument('--tbills', default='TB3MS.csv', metavar='FILE',
+                        help='3-month T-bill rates; without it, cash earns no interest (default: TB3MS.csv)')
+    args = parser.parse_args(argv)
+
+    market_data = load_market_data(args.shiller, args.tbills)
+    service = SimulationService(market_data, args.batch_delay / 1000, args.cache_size)
+    try:
+        asyncio.run(serve(service, args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
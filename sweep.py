@@ -0,0 +1,184 @@
+#!python3
+#
+# Run Portfolio.sim_periods over a grid of Portfolio settings and period
+# lengths, spreading the cases across processes.
+#
+# Example:
+#   python sweep.py -p 360,480 annual_withdrawal_rate=0.035,0.04 cash_cushion=False,True ratchet=False,True
+#
+# The output is a CSV table with one row per case: the Portfolio keyword
+# arguments, the period length, the summary fields of PeriodsResult, and
+# the percentiles of the growth rates (see PeriodsSummary).
+#
+# With --instrument FILE, the withdrawal branch counters and phase timings
+# of all the cases are added up and written to FILE as JSON; --profile
+# also runs the sweep under cProfile and tracemalloc (use -j 1 to profile
+# the simulations themselves, rather than the process pool).
+#
+
+import argparse
+import ast
+import csv
+import functools
+import itertools
+import os
+import sys
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from StockMarket2 import (Portfolio, PeriodsResult, PeriodsSummary, load_market_data, market_series,
+                          SharedMarketSeries, attach_series, Instrumentation)
+
+# Everything but the periods, plus the extra percentiles
+SUMMARY_FIELDS = PeriodsResult._fields[:-1] + PeriodsSummary.PERCENTILE_FIELDS
+
+# Market data for the current (worker) process, attached by _init_worker
+_market_data = None
+
+def _init_worker(handle):
+    global _market_data
+    _market_data = attach_series(handle)
+
+def _run_case(case, instrument=False):
+    # Returns (summary, instrumentation dict or None)
+    portfolio_args, period_length = case
+    instrumentation = Instrumentation() if instrument else None
+    portfolio = Portfolio(instrumentation=instrumentation, **portfolio_args)
+    result = portfolio.sim_periods_batch(_market_data, period_length, history='none')
+    summary = tuple(result[:-1]) + tuple(result.periods.summary.percentiles().values())
+    return summary, instrumentation and instrumentation.as_dict()
+
+def grid_cases(grid, period_lengths):
+    '''
+    Yield (portfolio_args, period_length) for every combination of the
+    values in @grid (a dict of Portfolio keyword argument to list of values)
+    and @period_lengths.
+
+    >>> for case in grid_cases({'ratchet': [False, True], 'annual_withdrawal_rate': [0.04]}, [360, 480]):
+    ...     print(case)
+    ({'ratchet': False, 'annual_withdrawal_rate': 0.04}, 360)
+    ({'ratchet': False, 'annual_withdrawal_rate': 0.04}, 480)
+    ({'ratchet': True, 'annual_withdrawal_rate': 0.04}, 360)
+    ({'ratchet': True, 'annual_withdrawal_rate': 0.04}, 480)
+    '''
+    names = list(grid)
+    for values in itertools.product(*grid.values()):
+        for period_length in period_lengths:
+            yield dict(zip(names, values)), period_length
+
+def sweep(grid, period_lengths=(360,), loader=load_market_data, workers=None, instrumentation=None):
+    '''
+    Simulate every combination of @grid and @period_lengths.  Returns a list
+    of namedtuples with one field per grid parameter, then period_length,
+    then SUMMARY_FIELDS.
+
+    @loader is called once, in this process, to get the market data.  The
+    workers share a single copy of it through shared memory.  With
+    workers=1, the cases run serially in this process.  The default loader
+    falls back to zero interest on cash without TB3MS.csv.
+
+    If @instrumentation (an Instrumentation) is given, the counters and
+    timings of every case are added to it.
+    '''
+    Row = namedtuple('SweepRow', list(grid) + ['period_length'] + list(SUMMARY_FIELDS))
+    cases = list(grid_cases(grid, period_lengths))
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(cases)))
+
+    global _market_data
+    if instrumentation is not None:
+        with instrumentation.phase('load'):
+            series = market_series(loader())
+    else:
+        series = market_series(loader())
+    run_case = functools.partial(_run_case, instrument=instrumentation is not None)
+    if workers == 1:
+        _market_data = series
+        outcomes = list(map(run_case, cases))
+    else:
+        chunksize = max(1, len(cases) // (workers * 4))
+        with SharedMarketSeries(series) as shared, \
+             ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(shared.handle,)) as executor:
+            outcomes = list(executor.map(run_case, cases, chunksize=chunksize))
+
+    summaries = [summary for summary, counts in outcomes]
+    if instrumentation is not None:
+        for summary, counts in outcomes:
+            instrumentation.merge(counts)
+
+    return [Row(*portfolio_args.values(), period_length, *summary)
+            for (portfolio_args, period_length), summary in zip(cases, summaries)]
+
+def parse_values(text):
+    '''
+    Parse a comma separated list of Python literals.  Anything that isn't
+    a literal is kept as a string.
+
+    >>> parse_values('0.035,0.04')
+    [0.035, 0.04]
+    >>> parse_values('True,False')
+    [True, False]
+    '''
+    values = []
+    for item in text.split(','):
+        try:
+            values.append(ast.literal_eval(item))
+        except (ValueError, SyntaxError):
+            values.append(item)
+    return values
+
+def parse_lengths(text):
+    '''
+    Parse a comma separated list of period lengths.
+
+    >>> parse_lengths('360,480')
+    [360, 480]
+    '''
+    try:
+        return [int(item) for item in text.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid period lengths: {text!r}') from None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Sweep Portfolio.sim_periods over a grid of settings.')
+    parser.add_argument('params', nargs='*', metavar='NAME=VALUE[,VALUE...]',
+                        help='Portfolio keyword argument and the values to try')
+    parser.add_argument('-p', '--period-length', type=parse_lengths, default=[360], metavar='LENGTH[,LENGTH...]',
+                        help='comma separated period lengths, in months (default: 360)')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='number of worker processes (default: one per CPU)')
+    parser.add_argument('--instrument', metavar='FILE',
+                        help='write withdrawal branch counters and phase timings to FILE as JSON')
+    parser.add_argument('--profile', action='store_true',
+                        help='with --instrument, also profile the sweep with cProfile and tracemalloc')
+    args = parser.parse_args(argv)
+
+    grid = {}
+    for param in args.params:
+        name, sep, values = param.partition('=')
+        if not sep:
+            parser.error(f'expected NAME=VALUE[,VALUE...], got {param!r}')
+        grid[name] = parse_values(values)
+
+    if args.profile and not args.instrument:
+        parser.error('--profile requires --instrument')
+    if args.instrument:
+        instrumentation = Instrumentation()
+        if args.profile:
+            with instrumentation.profile():
+                rows = sweep(grid, args.period_length, workers=args.workers,
+                             instrumentation=instrumentation)
+        else:
+            rows = sweep(grid, args.period_length, workers=args.workers,
+                         instrumentation=instrumentation)
+        instrumentation.write_json(args.instrument)
+    else:
+        rows = sweep(grid, args.period_length, workers=args.workers)
+    writer = csv.writer(sys.stdout)
+    writer.writerow(rows[0]._fields)
+    writer.writerows(rows)
+
+if __name__ == '__main__':
+    main()